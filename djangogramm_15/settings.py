@@ -42,6 +42,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 
     'feed.apps.FeedConfig',
 
@@ -54,11 +55,12 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'feed.middleware.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'feed.middleware.CachedAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -79,6 +81,8 @@ TEMPLATES = [
                 'django.contrib.messages.context_processors.messages',
                 'social_django.context_processors.backends',
                 'social_django.context_processors.login_redirect',
+                'feed.context_processors.push_events',
+                'feed.context_processors.unread_notifications',
             ],
         },
     },
@@ -126,6 +130,25 @@ USE_I18N = True
 
 USE_TZ = False
 
+# CACHE
+# redis://host:6379/0 in production, an in-process locmem cache when not set
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+
+# the session, user, follow graph and slug caches below are invalidated on write, which the other
+# processes only see through a shared cache. With the in-process cache they are read from the database
+SHARED_CACHE = CACHES['default']['BACKEND'] != 'django.core.cache.backends.locmem.LocMemCache'
+
+# sessions are read from the cache and written through to the database
+SESSION_ENGINE = ('django.contrib.sessions.backends.cached_db' if SHARED_CACHE
+                  else 'django.contrib.sessions.backends.db')
+# request.user and its profile, see feed.users, invalidated when either is saved
+USER_CACHE_TIMEOUT = 60 * 15
+
+# slug -> user id of the profile pages, current and former slugs
+SLUG_CACHE_TIMEOUT = 60 * 60 * 24
+
 # AWS
 AWS_ACCESS_KEY_ID = env('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = env('AWS_SECRET_ACCESS_KEY')
@@ -139,10 +162,41 @@ AWS_DEFAULT_ACL = env('AWS_DEFAULT_ACL')
 AWS_S3_VERITY = env('AWS_S3_VERITY')
 DEFAULT_FILE_STORAGE = env('DEFAULT_FILE_STORAGE')
 
+# image variants generated with celery, name: max width in px
+PHOTO_VARIANTS = {'thumb': 150, 'feed': 700, 'full': 1400}
+AVATAR_VARIANTS = {'thumb': 150}
+# parallel uploads to the file storage per post
+UPLOAD_THREADS = 4
+# presigned direct uploads from the browser
+UPLOAD_TICKET_EXPIRES = 600
+UPLOAD_MAX_SIZE = 10 * 1024 * 1024
+
 # SMTP WITH CELERY
 CELERY_BROKER_URL = env('CELERY_BROKER_URL')
 CELERY_RESULT_BACKEND = 'django-db'
 CELERY_CACHE_BACKEND = 'django-cache'
+CELERY_BEAT_SCHEDULE = {
+    'flush-like-deltas': {
+        'task': 'feed.tasks.flush_like_deltas',
+        'schedule': 5.0,
+    },
+    'rescore-posts': {
+        'task': 'feed.tasks.rescore_posts',
+        'schedule': 60.0,
+    },
+    'flush-outbound-email': {
+        'task': 'feed.tasks.flush_outbound_email',
+        'schedule': 30.0,
+    },
+    'aggregate-notifications': {
+        'task': 'feed.tasks.aggregate_notifications',
+        'schedule': 10.0,
+    },
+    'refresh-suggestions': {
+        'task': 'feed.tasks.refresh_suggestions',
+        'schedule': 60 * 60,
+    },
+}
 
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = env('EMAIL_HOST')
@@ -151,6 +205,14 @@ EMAIL_USE_TLS = env('EMAIL_USE_TLS')
 EMAIL_HOST_USER = env('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = env('EMAIL_HOST_PASSWORD')
 DEFAULT_FROM_EMAIL = env('DEFAULT_FROM_EMAIL')
+# outbound queue, see feed.mail: messages queued within MAIL_BATCH_DELAY seconds share an SMTP session
+MAIL_BATCH_DELAY = 2
+MAIL_BATCH_SIZE = 100
+MAIL_MAX_ATTEMPTS = 5
+# seconds before the first retry, doubled on every further attempt
+MAIL_RETRY_BACKOFF = 30
+# a message claimed that long ago by a flush that never finished is sent again
+MAIL_CLAIM_TIMEOUT = 10 * 60
 
 # django-registration
 ACCOUNT_ACTIVATION_DAYS = 3
@@ -166,6 +228,77 @@ SOCIAL_AUTH_GOOGLE_OAUTH2_SECRET = env('SOCIAL_AUTH_GOOGLE_OAUTH2_SECRET')
 CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap5"
 CRISPY_TEMPLATE_PACK = "bootstrap5"
 
+# cursor pagination
+FEED_PAGE_SIZE = 20
+FOLLOWERS_PAGE_SIZE = 50
+
+# cached follower/following id sets, see feed.graph
+FOLLOW_GRAPH_TIMEOUT = 60 * 60 * 24
+
+# ranked feed, see feed.ranking: a post that is RANK_HALF_LIFE seconds older needs twice the likes
+RANK_HALF_LIFE = 6 * 60 * 60
+# bonus of the authors following the viewer back and of the authors the viewer liked (per doubling)
+RANK_AFFINITY_MUTUAL = 1.0
+RANK_AFFINITY_LIKES = 0.5
+# the timeline entries of older posts keep their score when the post gets likes, see feed.ranking.rescore
+RANK_RESCORE_WINDOW = 3 * 24 * 60 * 60
+
+# text search configuration of posts and bios, see feed.search
+SEARCH_CONFIG = 'english'
+# users taken from each of the username prefix, trigram and text matches before sorting by followers
+SEARCH_CANDIDATES = 500
+
+# inbox, see feed.notifications: likes and follows are staged and aggregated by celery beat
+NOTIFICATIONS_BATCH_SIZE = 5000
+NOTIFICATIONS_PAGE_SIZE = 20
+NOTIFICATIONS_UNREAD_TIMEOUT = 60 * 60 * 24
+
+# "who to follow", see feed.recommendations
+SUGGESTIONS_PER_USER = 20
+SUGGESTIONS_SHOWN = 5
+# the most followed accounts every user gets as candidates
+SUGGESTIONS_POPULAR = 50
+
+# home timeline
+TIMELINE_BACKFILL_SIZE = 50
+TIMELINE_BATCH_SIZE = 1000
+# authors with at least that many followers are merged into the feed on read instead of fan-out
+TIMELINE_CELEBRITY_FOLLOWERS = 10000
+
+# buffer like_count changes and apply them in batches with celery beat (feed.tasks.flush_like_deltas)
+LIKE_BUFFER_WRITES = env.bool('LIKE_BUFFER_WRITES', default=False)
+
+# route the feed, profile, post and like views to feed.async_views, for ASGI servers only:
+# under WSGI every coroutine view would be run through async_to_sync
+FEED_ASYNC_VIEWS = env.bool('FEED_ASYNC_VIEWS', default=False)
+
+# server-sent like counts and new posts, see feed.events. ASGI only, a WSGI server would hold a thread per client
+PUSH_EVENTS = env.bool('PUSH_EVENTS', default=False)
+# seconds between keep-alive comments on an idle stream
+PUSH_EVENTS_HEARTBEAT = 15
+# seconds before a stream ends and the browser reconnects
+PUSH_EVENTS_MAX_AGE = 300
+# events buffered for a slow client before new ones are dropped
+PUSH_EVENTS_QUEUE_SIZE = 100
+
+# share of the requests instrumented, see feed.middleware. Off by default, e.g. 0.05 to turn it on
+INSTRUMENTATION_SAMPLE_RATE = env.float('INSTRUMENTATION_SAMPLE_RATE', default=0)
+# the same statement that many times in one request is logged as an N+1
+INSTRUMENTATION_DUPLICATE_THRESHOLD = 5
+# bearer token of the metrics scraper, staff users can always read the metrics
+METRICS_TOKEN = env('METRICS_TOKEN', default='')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'feed.instrumentation': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
+
 # extending the default User model
 AUTH_USER_MODEL = 'feed.User'
 
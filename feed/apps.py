@@ -6,4 +6,6 @@ class FeedConfig(AppConfig):
     name = 'feed'
 
     def ready(self):
-        from feed import signals
+        from django.db.models.signals import post_migrate
+        from feed import checks, search, signals
+        post_migrate.connect(search.create_indexes, sender=self)
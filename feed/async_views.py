@@ -0,0 +1,127 @@
+"""
+Coroutine versions of the read-heavy views, routed instead of the sync ones when FEED_ASYNC_VIEWS is set
+and the site is served through djangogramm_15.asgi. Writes are left to the sync views: Django has no async
+transactions yet, so they run in the request's sync thread like any sync view under ASGI
+"""
+import asyncio
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.views import redirect_to_login
+from django.http import Http404, HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
+from django.shortcuts import render
+
+from feed import counters, events, graph, recommendations, slugs, timeline, views
+from feed.forms import CreatePostForm, PostImageFormSet
+from feed.models import Post, Profile
+from feed.pagination import KeysetPaginator, alist
+
+# templates may still touch lazy relations, render them off the event loop
+_render = sync_to_async(render)
+
+
+def login_required(view):
+    """
+    django.contrib.auth's login_required only wraps sync views before Django 5
+    """
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        # the session and the user are loaded by the lazy request.user, which is sync
+        if not await sync_to_async(lambda: request.user.is_authenticated)():
+            return redirect_to_login(request.get_full_path(), settings.LOGIN_URL)
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+@login_required
+async def index(request):
+    if request.method != 'GET':
+        # new posts upload photos and write in a transaction
+        return await sync_to_async(views.IndexView.as_view())(request)
+    feed_mode = await Profile.objects.filter(user=request.user).values_list('feed_mode', flat=True).aget()
+    posts_data = await timeline.aget_timeline(request.user, request.GET.get('cursor'),
+                                              ranked=feed_mode == Profile.RANKED)
+    context = {
+        'posts_data': posts_data,
+        'feed_mode': feed_mode,
+        'feed_modes': Profile.FEED_MODES,
+        'next_page_url': views._next_page_url(posts_data),
+        'form': CreatePostForm(),
+        'form_images': PostImageFormSet()
+    }
+
+    # ask to follow somebody
+    if not posts_data:
+        context['suggested_users'] = await sync_to_async(recommendations.for_user)(
+            request.user, settings.SUGGESTIONS_SHOWN)
+
+    return await _render(request, 'feed/index.html', context)
+
+
+@login_required
+async def profile_detail(request, slug):
+    if request.method != 'GET':
+        # following writes the edge and both counters in a transaction
+        return await sync_to_async(views.ProfileView.as_view())(request, slug=slug)
+    profile = await sync_to_async(slugs.lookup)(slug, views.ProfileSlugMixin.profile_queryset)
+    if profile is None:
+        raise Http404('No such profile.')
+    if profile.slug != slug:
+        return views._current_slug_redirect(request, profile, slug=slug)
+
+    viewer_id = request.user.id
+    posts = Post.objects.for_feed(request.user).filter(user_id=profile.user_id)
+    viewer_followings, profile_followings, page = await asyncio.gather(
+        graph.afollowings(viewer_id), graph.afollowings(profile.user_id),
+        KeysetPaginator(posts).apage(request.GET.get('cursor')))
+    known = graph.known_followers(profile.user_id, viewer_followings)
+    context = {
+        'object': profile,
+        'profile': profile,
+        'is_following': profile.user_id in viewer_followings,
+        'follows_viewer': viewer_id in profile_followings,
+        'known_followers': await alist(graph.known_follower_names(known)),
+        'known_followers_count': await known.acount(),
+        'posts': page,
+        'next_page_url': views._next_page_url(page, slug=profile.slug),
+    }
+    return await _render(request, 'feed/profile.html', context)
+
+
+@login_required
+async def post_detail(request, pk):
+    try:
+        post = await Post.objects.for_feed(request.user).aget(pk=pk)
+    except Post.DoesNotExist:
+        raise Http404('No such post.')
+    return await _render(request, 'feed/post.html', {'object': post, 'post': post})
+
+
+@login_required
+async def like(request):
+    """
+    See feed.views.like
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    post_id, liked = views._like_params(request)
+    if post_id is None:
+        return JsonResponse({'errors': ['Expected a post_id and action=like|unlike.']}, status=400)
+    try:
+        count = await sync_to_async(counters.set_like)(request.user.id, post_id, liked)
+    except Post.DoesNotExist:
+        raise Http404('No such post.')
+    return JsonResponse({'liked': liked, 'like_count': count})
+
+
+@login_required
+async def push_events(request):
+    """
+    Server-sent like counts and new posts of the people the viewer follows. An idle client costs
+    a coroutine and a small queue, no thread, so this is served over ASGI only (PUSH_EVENTS)
+    """
+    followings = await graph.afollowings(request.user.id)
+    channels = [events.author_channel(user_id) for user_id in followings | {request.user.id}]
+    return StreamingHttpResponse(events.stream(request.user.id, channels), content_type='text/event-stream',
+                                 headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
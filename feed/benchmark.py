@@ -0,0 +1,219 @@
+import platform
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import cycle
+from urllib.parse import urljoin
+from uuid import uuid4
+
+import django
+import requests as http
+from django.conf import settings
+from django.db import connection
+from django.middleware.csrf import CSRF_ALLOWED_CHARS, CSRF_SECRET_LENGTH
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+from djangogramm_15.celery import app as celery_app
+from feed.models import Post, Profile, User
+
+# graded datasets for seed_data
+DATASETS = {
+    '1k': {'users': 100, 'posts': 1000},
+    '100k': {'users': 5000, 'posts': 100000},
+    '1m': {'users': 50000, 'posts': 1000000},
+}
+
+PERCENTILES = (50, 90, 95, 99)
+
+LIKE_ACTIONS = ('like', 'unlike')
+
+# fields compared by benchmark_compare, all of them are "lower is better"
+COMPARED = ('p50_ms', 'p95_ms', 'p99_ms', 'queries_max', 'bytes_mean')
+
+
+def percentile(values, rank):
+    values = sorted(values)
+    position = (len(values) - 1) * rank / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(latencies, queries, sizes):
+    result = {f'p{rank}_ms': round(percentile(latencies, rank) * 1000, 3) for rank in PERCENTILES}
+    result.update({
+        'mean_ms': round(statistics.mean(latencies) * 1000, 3),
+        'requests': len(latencies),
+        'queries_median': statistics.median(queries),
+        'queries_max': max(queries),
+        'bytes_mean': round(statistics.mean(sizes)),
+    })
+    return result
+
+
+def measure(send, requests, warmup=3):
+    """
+    Call `send()` (which returns a response) and record latency, query count and rendered bytes
+    """
+    for _ in range(warmup):
+        send()
+    latencies, queries, sizes = [], [], []
+    for _ in range(requests):
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            response = send()
+            latencies.append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            raise RuntimeError(f'{response.status_code} from {response.request["PATH_INFO"]}')
+        queries.append(len(captured))
+        sizes.append(len(response.content))
+    return summarize(latencies, queries, sizes)
+
+
+def pick_subjects():
+    """
+    The heaviest accounts of the dataset: the hot paths are worst for them
+    """
+    viewer = User.objects.annotate(followings_total=Count('followings')).order_by('-followings_total').first()
+    profile = Profile.objects.select_related('user').order_by('-followers_count').first()
+    post = Post.objects.order_by('-like_count').first()
+    return viewer, profile, post
+
+
+def run(requests=50):
+    viewer, profile, post = pick_subjects()
+    client = Client()
+    client.force_login(viewer)
+    anonymous = Client()
+
+    # liking is set-state, an already liked post would only measure the no-op
+    actions = cycle(LIKE_ACTIONS)
+
+    def like():
+        return client.post(reverse('feed:like'), {'post_id': post.id, 'action': next(actions)})
+
+    def register():
+        username = f'bench_{uuid4().hex[:18]}'
+        return anonymous.post(reverse('feed:django_registration_register'), {
+            'username': username,
+            'email': f'{username}@example.com',
+            'password1': 'Bench-password-1',
+            'password2': 'Bench-password-1',
+        })
+
+    endpoints = {
+        'index': lambda: client.get(reverse('feed:index')),
+        'profile': lambda: client.get(reverse('feed:profile', args=(profile.slug,))),
+        'post': lambda: client.get(reverse('feed:post', args=(post.id,))),
+        'followers': lambda: client.get(reverse('feed:followers', args=(profile.slug,))),
+        'like': like,
+        'registration': register,
+    }
+    return {
+        'meta': {
+            'date': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'posts': Post.objects.count(),
+            'users': User.objects.count(),
+        },
+        'endpoints': measure_all(endpoints, requests),
+    }
+
+
+def measure_all(endpoints, requests):
+    # registration sends its email through celery, keep it in-process and in memory
+    eager = celery_app.conf.task_always_eager
+    celery_app.conf.task_always_eager = True
+    try:
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+            return {name: measure(send, requests) for name, send in endpoints.items()}
+    finally:
+        celery_app.conf.task_always_eager = eager
+
+
+def compare(baseline, current, threshold=0.1):
+    """
+    Rows of (endpoint, field, baseline, current, change) and whether any field regressed beyond the threshold
+    """
+    rows, regressed = [], False
+    for name, results in current['endpoints'].items():
+        before = baseline['endpoints'].get(name)
+        if before is None:
+            continue
+        for field in COMPARED:
+            old, new = before[field], results[field]
+            change = (new - old) / old if old else (0.0 if new == old else float('inf'))
+            # query counts must not grow at all, timings get some slack for noise
+            worse = new > old if field.startswith('queries') else change > threshold
+            regressed = regressed or worse
+            rows.append((name, field, old, new, change, worse))
+    return rows, regressed
+
+
+def load(base_url, requests=1000, concurrency=100, timeout=30):
+    """
+    Throughput of a running server: `concurrency` clients share `requests` requests to each hot endpoint.
+    Run it once against a WSGI and once against an ASGI server of the same database to compare them
+    """
+    viewer, profile, post = pick_subjects()
+    client = Client()
+    client.force_login(viewer)
+    csrf_token = get_random_string(CSRF_SECRET_LENGTH, allowed_chars=CSRF_ALLOWED_CHARS)
+    cookies = {settings.SESSION_COOKIE_NAME: client.cookies[settings.SESSION_COOKIE_NAME].value,
+               settings.CSRF_COOKIE_NAME: csrf_token}
+    # the payloads are sent in turn, liking alternates with unliking to write on every request
+    endpoints = {
+        'index': ('get', reverse('feed:index'), [None]),
+        'profile': ('get', reverse('feed:profile', args=(profile.slug,)), [None]),
+        'post': ('get', reverse('feed:post', args=(post.id,)), [None]),
+        'like': ('post', reverse('feed:like'), [{'post_id': post.id, 'action': action} for action in LIKE_ACTIONS]),
+    }
+    sessions = threading.local()
+
+    def send(method, url, data):
+        if not hasattr(sessions, 'session'):
+            # one keep-alive connection per client
+            sessions.session = http.Session()
+            sessions.session.cookies.update(cookies)
+            sessions.session.headers.update({'X-CSRFToken': csrf_token, 'Referer': base_url})
+        start = time.perf_counter()
+        try:
+            ok = sessions.session.request(method, url, data=data, timeout=timeout,
+                                          allow_redirects=False).status_code < 300
+        except http.RequestException:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for name, (method, path, payloads) in endpoints.items():
+            url = urljoin(base_url, path)
+            start = time.perf_counter()
+            outcomes = list(executor.map(lambda number: send(method, url, payloads[number % len(payloads)]),
+                                         range(requests)))
+            elapsed = time.perf_counter() - start
+            latencies = [latency for latency, _ in outcomes]
+            results[name] = {
+                'requests_per_s': round(requests / elapsed, 1),
+                **{f'p{rank}_ms': round(percentile(latencies, rank) * 1000, 3) for rank in PERCENTILES},
+                'errors': sum(not ok for _, ok in outcomes),
+            }
+    return {
+        'meta': {
+            'date': timezone.now().isoformat(),
+            'url': base_url,
+            'requests': requests,
+            'concurrency': concurrency,
+            'posts': Post.objects.count(),
+            'users': User.objects.count(),
+        },
+        'endpoints': results,
+    }
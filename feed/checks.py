@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+
+@register(Tags.caches)
+def shared_cache(app_configs, **kwargs):
+    """
+    The session, user, follow graph and slug caches are only kept with a cache every process shares
+    """
+    if settings.SHARED_CACHE or settings.DEBUG:
+        return []
+    return [Warning(
+        'The default cache is local to the process, sessions, request.user, the follow graph and '
+        'profile slugs are read from the database on every request.',
+        hint='Set CACHE_URL to a shared cache such as redis://host:6379/0.',
+        id='feed.W001',
+    )]
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.urls import reverse
+from django.utils.functional import SimpleLazyObject
+
+from feed import notifications
+
+
+def push_events(request):
+    """
+    The url of the event stream for feed/push_events.html, None when push events are off
+    """
+    return {'push_events_url': reverse('feed:push_events') if settings.PUSH_EVENTS else None}
+
+
+def unread_notifications(request):
+    """
+    The navbar badge, looked up from the cache only when a template shows it
+    """
+    return {'unread_notifications': SimpleLazyObject(
+        lambda: notifications.unread_count(request.user.id) if request.user.is_authenticated else 0)}
@@ -0,0 +1,131 @@
+from collections import Counter
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from feed import events, notifications
+from feed.models import Follower, Like, LikeDelta, NotificationEvent, Post, Profile
+
+
+def _shift(field, delta):
+    # never below zero, even when the stored counter has drifted
+    return Greatest(F(field) + delta, Value(0))
+
+
+def add_likes(post_id, delta):
+    if settings.LIKE_BUFFER_WRITES:
+        # viral posts get bursts of likes, don't serialize them all on the post row lock
+        LikeDelta.objects.create(post_id=post_id, delta=delta)
+    else:
+        Post.objects.filter(pk=post_id).update(like_count=_shift('like_count', delta))
+
+
+def insert_like(user_id, post_id):
+    """
+    One statement and no IntegrityError on double clicks, returns whether the like is new
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f'INSERT INTO {Like._meta.db_table} (user_id, post_id) VALUES (%s, %s) '
+                       f'ON CONFLICT DO NOTHING', [user_id, post_id])
+        return cursor.rowcount == 1
+
+
+def _like_count_and_author(post_id):
+    pending = Coalesce(Subquery(LikeDelta.objects.filter(post=OuterRef('pk')).order_by()
+                                .values('post').annotate(total=Sum('delta')).values('total')), Value(0))
+    row = Post.objects.filter(pk=post_id).values_list(
+        (F('like_count') + pending) if settings.LIKE_BUFFER_WRITES else F('like_count'), 'user_id').first()
+    return (None, None) if row is None else (max(row[0], 0), row[1])
+
+
+def like_count(post_id):
+    """
+    The stored count plus the buffered changes, None for a missing post
+    """
+    return _like_count_and_author(post_id)[0]
+
+
+def set_like(user_id, post_id, liked):
+    """
+    Like or unlike a post in one transaction and return its like count.
+    Raises Post.DoesNotExist, with the like rolled back, for a missing post
+    """
+    with transaction.atomic():
+        if liked:
+            changed = insert_like(user_id, post_id)
+        else:
+            changed, _ = Like.objects.filter(user_id=user_id, post_id=post_id).delete()
+        if changed:
+            add_likes(post_id, 1 if liked else -1)
+        count, author_id = _like_count_and_author(post_id)
+        if count is None:
+            raise Post.DoesNotExist('No such post.')
+        if changed:
+            events.publish_like(author_id, post_id, count)
+        if changed and liked:
+            notifications.record(NotificationEvent.LIKE, author_id, user_id, post_id)
+    return count
+
+
+def flush_likes(batch_size=10000):
+    """
+    Apply the buffered like_count changes, one update per post. Returns the number of applied deltas
+    """
+    flushed = 0
+    while True:
+        with transaction.atomic():
+            # concurrent flushes take different rows
+            deltas = list(LikeDelta.objects.select_for_update(skip_locked=True).order_by('pk')
+                          .values_list('pk', 'post_id', 'delta')[:batch_size])
+            if not deltas:
+                return flushed
+            totals = Counter()
+            for _, post_id, delta in deltas:
+                totals[post_id] += delta
+            for post_id, total in totals.items():
+                if total:
+                    Post.objects.filter(pk=post_id).update(like_count=_shift('like_count', total))
+            LikeDelta.objects.filter(pk__in=[pk for pk, _, _ in deltas]).delete()
+        flushed += len(deltas)
+
+
+def add_follows(follower_id, following_id, delta):
+    if follower_id == following_id:
+        # the self-follow row only feeds the timeline
+        return
+    Profile.objects.filter(user_id=following_id).update(followers_count=_shift('followers_count', delta))
+    Profile.objects.filter(user_id=follower_id).update(following_count=_shift('following_count', delta))
+
+
+def _batches(model, batch_size):
+    last_id = 0
+    while ids := list(model.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size]):
+        yield model.objects.filter(pk__in=ids)
+        last_id = ids[-1]
+
+
+def reconcile(batch_size=10000):
+    """
+    Recount the stored counters from the source tables, returns the number of fixed rows
+    """
+    flush_likes(batch_size)
+    fixed = 0
+    likes = (Like.objects.filter(post=OuterRef('pk')).order_by()
+             .values('post').annotate(count=Count('id')).values('count'))
+    followers = (Follower.objects.filter(following=OuterRef('user')).exclude(follower=F('following'))
+                 .order_by().values('following').annotate(count=Count('id')).values('count'))
+    followings = (Follower.objects.filter(follower=OuterRef('user')).exclude(follower=F('following'))
+                  .order_by().values('follower').annotate(count=Count('id')).values('count'))
+
+    for posts in _batches(Post, batch_size):
+        actual = Coalesce(Subquery(likes), Value(0))
+        fixed += posts.annotate(actual=actual).exclude(like_count=F('actual')).update(like_count=actual)
+    for profiles in _batches(Profile, batch_size):
+        actual_followers = Coalesce(Subquery(followers), Value(0))
+        actual_followings = Coalesce(Subquery(followings), Value(0))
+        fixed += (profiles.annotate(actual_followers=actual_followers, actual_followings=actual_followings)
+                  .exclude(followers_count=F('actual_followers'), following_count=F('actual_followings'))
+                  .update(followers_count=actual_followers, following_count=actual_followings))
+    return fixed
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import threading
+import time
+from collections import defaultdict
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+
+
+def author_channel(user_id):
+    """
+    Likes on the user's posts and the user's new posts, streamed to the followers
+    """
+    return f'author:{user_id}'
+
+
+class Subscription:
+
+    def __init__(self, loop, channels):
+        self.loop = loop
+        self.channels = tuple(channels)
+        self.queue = asyncio.Queue(maxsize=settings.PUSH_EVENTS_QUEUE_SIZE)
+
+    def deliver(self, event):
+        # publishers run in request threads, the queue belongs to the event loop of the stream
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            pass  # the loop is closed, the stream is gone
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            pass  # a stalled client misses updates instead of holding memory
+
+    async def get(self, timeout):
+        """
+        The next events, at least one, or [] after `timeout` seconds
+        """
+        try:
+            events = [await asyncio.wait_for(self.queue.get(), timeout)]
+        except asyncio.TimeoutError:
+            return []
+        while not self.queue.empty():
+            events.append(self.queue.get_nowait())
+        return events
+
+
+class Broker:
+    """
+    Publish/subscribe between the threads of this process and its event streams. A stand-in for
+    Redis pub/sub, events published in another process (a celery worker, another server) are not seen
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)
+
+    def subscribe(self, channels):
+        subscription = Subscription(asyncio.get_running_loop(), channels)
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscriptions[channel].discard(subscription)
+                if not self._subscriptions[channel]:
+                    del self._subscriptions[channel]
+
+    def publish(self, channel, event):
+        """
+        Returns the number of subscriptions the event was delivered to
+        """
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.deliver(event)
+        return len(subscriptions)
+
+
+broker = Broker()
+
+
+def publish_on_commit(channel, event):
+    transaction.on_commit(partial(broker.publish, channel, event))
+
+
+def publish_like(author_id, post_id, like_count):
+    publish_on_commit(author_channel(author_id), {'type': 'like', 'post_id': post_id, 'like_count': like_count})
+
+
+def publish_post(post):
+    publish_on_commit(author_channel(post.user_id), {'type': 'post', 'post_id': post.id, 'author_id': post.user_id})
+
+
+def _coalesce(events):
+    # a burst of likes on one post only needs its last count
+    likes = {event['post_id']: event for event in events if event['type'] == 'like'}
+    return [event for event in events if event['type'] != 'like' or likes[event['post_id']] is event]
+
+
+async def stream(viewer_id, channels):
+    """
+    Server-sent events of the channels. Ends after PUSH_EVENTS_MAX_AGE, the browser reconnects
+    with its current followings, and a stream of a client that went away doesn't outlive that
+    """
+    subscription = broker.subscribe(channels)
+    deadline = time.monotonic() + settings.PUSH_EVENTS_MAX_AGE
+    try:
+        yield 'retry: 5000\n\n'
+        while (remaining := deadline - time.monotonic()) > 0:
+            events = await subscription.get(min(settings.PUSH_EVENTS_HEARTBEAT, remaining))
+            if not events:
+                # keeps proxies from closing the idle connection
+                yield ': keep-alive\n\n'
+                continue
+            for event in _coalesce(events):
+                if event.get('author_id') == viewer_id:
+                    continue  # the author's own new post
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+    finally:
+        broker.unsubscribe(subscription)
@@ -0,0 +1,61 @@
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from uuid import uuid4
+
+from django.core.files import File
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F
+
+from feed.models import Follower, Like, Photo, Profile
+
+CHUNK_SIZE = 64 * 1024
+ROWS_PER_QUERY = 2000
+
+
+def _write_lines(archive, name, rows):
+    """
+    One JSON object per line, rows are streamed from a server-side cursor
+    """
+    with archive.open(name, 'w', force_zip64=True) as entry:
+        for row in rows.iterator(chunk_size=ROWS_PER_QUERY):
+            entry.write(json.dumps(row, cls=DjangoJSONEncoder).encode() + b'\n')
+
+
+def _write_photos(archive, user):
+    for photo_id, post_id, name in (Photo.objects.filter(user=user).order_by('pk')
+                                    .values_list('id', 'post_id', 'photo').iterator(chunk_size=ROWS_PER_QUERY)):
+        storage = Photo._meta.get_field('photo').storage
+        if not storage.exists(name):
+            continue
+        with storage.open(name, 'rb') as source, \
+                archive.open(f'photos/{post_id}_{photo_id}_{os.path.basename(name)}', 'w', force_zip64=True) as entry:
+            shutil.copyfileobj(source, entry, CHUNK_SIZE)
+
+
+def build_archive(export):
+    """
+    Zip the user's data into a temporary file on disk and upload it to the export's storage,
+    memory stays bounded by the chunk sizes whatever the size of the account
+    """
+    user = export.user
+    with tempfile.TemporaryFile() as buffer:
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            profile = Profile.objects.filter(user=user).values('full_name', 'bio', 'slug').first() or {}
+            archive.writestr('profile.json', json.dumps(
+                {'username': user.username, 'email': user.email, 'date_joined': user.date_joined, **profile},
+                cls=DjangoJSONEncoder, indent=2))
+            _write_lines(archive, 'posts.jsonl', user.posts.order_by('pk').values(
+                'id', 'text', 'pub_date', 'like_count'))
+            _write_lines(archive, 'likes.jsonl', Like.objects.filter(user=user).order_by('pk').values(
+                'post_id', author=F('post__user__username')))
+            _write_lines(archive, 'followers.jsonl', Follower.objects.filter(following=user)
+                         .exclude(follower=F('following')).order_by('pk').values(username=F('follower__username')))
+            _write_lines(archive, 'followings.jsonl', Follower.objects.filter(follower=user)
+                         .exclude(follower=F('following')).order_by('pk').values(username=F('following__username')))
+            _write_photos(archive, user)
+        buffer.seek(0)
+        # not guessable, the storage may serve it without authentication
+        export.archive.save(f'{user.id}/{user.username}-{uuid4().hex}.zip', File(buffer), save=False)
@@ -2,10 +2,11 @@ from django import forms
 from django.contrib.auth.forms import PasswordResetForm
 from django.forms import ModelForm, Textarea
 from django.forms.models import inlineformset_factory
+from django.template.loader import render_to_string
 from django_registration.forms import RegistrationForm
 
+from feed import mail
 from feed.models import Post, User, Profile, Photo
-from feed.tasks import send_reset_email_async, send_register_email_async
 
 
 class CustomRegisterForm(RegistrationForm):
@@ -20,12 +21,10 @@ class CustomPasswordResetForm(PasswordResetForm):
 
     def send_mail(self, subject_template_name, email_template_name, context,
                   from_email, to_email, html_email_template_name=None):
-        context['user'] = context['user'].id
-
-        send_reset_email_async.delay(subject_template_name=subject_template_name,
-                                     email_template_name=email_template_name,
-                                     context=context, from_email=from_email, to_email=to_email,
-                                     html_email_template_name=html_email_template_name)
+        # rendered here with the user at hand, the queue sends it in the next batch
+        subject = ''.join(render_to_string(subject_template_name, context).splitlines())
+        html_body = render_to_string(html_email_template_name, context) if html_email_template_name else ''
+        mail.enqueue(to_email, subject, render_to_string(email_template_name, context), html_body, from_email)
 
 
 class MultipleFileInput(forms.ClearableFileInput):
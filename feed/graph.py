@@ -0,0 +1,96 @@
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+
+from feed.models import Follower, User
+
+
+def _key(kind, user_id):
+    return f'graph:{kind}:{user_id}'
+
+
+def _edges(kind, user_id):
+    if kind == 'followers':
+        edges = Follower.objects.filter(following_id=user_id).values_list('follower_id', flat=True)
+    else:
+        edges = Follower.objects.filter(follower_id=user_id).values_list('following_id', flat=True)
+    return edges.exclude(follower=F('following')).order_by()
+
+
+def _ids(kind, user_id):
+    """
+    The cached set of ids on one side of the user's follow edges, the self-follow row excluded
+    """
+    if not settings.SHARED_CACHE:
+        return frozenset(_edges(kind, user_id).iterator())
+    key = _key(kind, user_id)
+    ids = cache.get(key)
+    if ids is None:
+        ids = frozenset(_edges(kind, user_id).iterator())
+        cache.set(key, ids, settings.FOLLOW_GRAPH_TIMEOUT)
+    return ids
+
+
+async def _aids(kind, user_id):
+    if not settings.SHARED_CACHE:
+        return frozenset([edge async for edge in _edges(kind, user_id)])
+    key = _key(kind, user_id)
+    ids = await cache.aget(key)
+    if ids is None:
+        ids = frozenset([edge async for edge in _edges(kind, user_id)])
+        await cache.aset(key, ids, settings.FOLLOW_GRAPH_TIMEOUT)
+    return ids
+
+
+def followers(user_id):
+    return _ids('followers', user_id)
+
+
+def followings(user_id):
+    return _ids('followings', user_id)
+
+
+async def afollowers(user_id):
+    return await _aids('followers', user_id)
+
+
+async def afollowings(user_id):
+    return await _aids('followings', user_id)
+
+
+def is_following(follower_id, following_id):
+    return following_id in followings(follower_id)
+
+
+def mutual(user_id):
+    """
+    Users who follow the user back
+    """
+    return followers(user_id) & followings(user_id)
+
+
+def known_followers(user_id, viewer_followings):
+    """
+    Follow rows of the user by the people the viewer follows. Looked up from the viewer's followings
+    through the (follower, following) index, a popular user's follower set is never loaded
+    """
+    return Follower.objects.filter(following_id=user_id, follower_id__in=viewer_followings)
+
+
+def known_follower_names(known, limit=3):
+    return (User.objects.filter(id__in=known.order_by('follower_id').values('follower_id')[:limit])
+            .order_by('username'))
+
+
+def _forget(*keys):
+    cache.delete_many(keys)
+
+
+def invalidate(follower_id, following_id):
+    keys = (_key('followings', follower_id), _key('followers', following_id))
+    _forget(*keys)
+    # a request reading before the commit may have cached the old edges again
+    transaction.on_commit(partial(_forget, *keys))
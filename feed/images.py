@@ -0,0 +1,60 @@
+import os
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+FORMATS = {
+    'webp': 'WEBP',
+    'jpeg': 'JPEG',
+}
+
+
+def generate_variants(field_file, sizes):
+    """
+    Save resized WebP and JPEG copies of an image next to the original, without its EXIF data.
+    Returns {variant: {'width': ..., 'webp': name, 'jpeg': name}} for the model to keep
+    """
+    storage = field_file.storage
+    with field_file.open('rb') as file:
+        image = ImageOps.exif_transpose(Image.open(file))
+        image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+        # palette (GIF, PNG-8) and grayscale images keep their transparency in image.info
+        alpha = 'A' in image.getbands() or 'transparency' in image.info
+        image = image.convert('RGBA' if alpha else 'RGB')
+
+    base, _ = os.path.splitext(field_file.name)
+    variants, by_width = {}, {}
+    for variant, width in sizes.items():
+        resized = image
+        if image.width > width:
+            resized = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+        if resized.width in by_width:
+            # an image narrower than several sizes, they share one copy
+            variants[variant] = by_width[resized.width]
+            continue
+        variants[variant] = by_width[resized.width] = {'width': resized.width}
+        for extension, image_format in FORMATS.items():
+            buffer = BytesIO()
+            # a fresh save doesn't carry over the original EXIF block
+            (resized.convert('RGB') if image_format == 'JPEG' else resized).save(
+                buffer, image_format, quality=82, optimize=True)
+            variants[variant][extension] = storage.save(f'{base}_{variant}.{extension}',
+                                                        ContentFile(buffer.getvalue()))
+    return variants
+
+
+def srcset(storage, variants, extension):
+    # one candidate per width, duplicate descriptors make the whole srcset invalid
+    by_width = {variant['width']: variant for variant in variants.values()}
+    return ', '.join(f"{storage.url(by_width[width][extension])} {width}w" for width in sorted(by_width))
+
+
+def variant_url(field_file, variants, name, extension='jpeg'):
+    """
+    URL of a processed variant, the original until the processing has finished
+    """
+    if name in variants:
+        return field_file.storage.url(variants[name][extension])
+    return field_file.url
@@ -0,0 +1,150 @@
+import datetime
+import logging
+import smtplib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from feed.models import OutboundEmail
+
+logger = logging.getLogger(__name__)
+
+METRICS = ('queued', 'sent', 'retried', 'failed')
+FLUSH_SCHEDULED = 'mail:flush-scheduled'
+
+# one SMTP connection per worker process, reused by every flush
+_connection = None
+
+
+def _count(metric, amount=1):
+    key = f'mail:{metric}'
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        # evicted between add and incr
+        cache.set(key, amount, timeout=None)
+
+
+def metrics():
+    values = cache.get_many([f'mail:{metric}' for metric in METRICS])
+    return {metric: values.get(f'mail:{metric}', 0) for metric in METRICS}
+
+
+def render_metrics():
+    """
+    Delivery counters in the Prometheus text format, appended to the metrics endpoint
+    """
+    lines = ['# TYPE djangogramm_emails_total counter']
+    lines += [f'djangogramm_emails_total{{status="{metric}"}} {value}' for metric, value in metrics().items()]
+    return '\n'.join(lines) + '\n'
+
+
+def enqueue(to, subject, body, html_body='', from_email=None):
+    """
+    Queue a message and make sure a flush runs soon. Messages queued within MAIL_BATCH_DELAY
+    of each other share one flush, and so one SMTP session
+    """
+    from feed.tasks import flush_outbound_email
+
+    email = OutboundEmail.objects.create(to=to, subject=subject, body=body, html_body=html_body,
+                                         from_email=from_email or settings.DEFAULT_FROM_EMAIL)
+    _count('queued')
+
+    def schedule():
+        if cache.add(FLUSH_SCHEDULED, True, timeout=settings.MAIL_BATCH_DELAY):
+            flush_outbound_email.apply_async(countdown=settings.MAIL_BATCH_DELAY)
+    transaction.on_commit(schedule)
+    return email
+
+
+def _get_connection():
+    global _connection
+    if _connection is None:
+        _connection = get_connection()
+    _connection.open()
+    return _connection
+
+
+def _reset_connection():
+    global _connection
+    if _connection is not None:
+        try:
+            _connection.close()
+        except Exception:
+            pass
+    _connection = None
+
+
+def _send(email):
+    message = EmailMultiAlternatives(email.subject, email.body, email.from_email, [email.to],
+                                     connection=_get_connection())
+    if email.html_body:
+        message.attach_alternative(email.html_body, 'text/html')
+    try:
+        message.send()
+    except smtplib.SMTPServerDisconnected:
+        # the server dropped the idle connection, one more try on a fresh one
+        _reset_connection()
+        message.connection = _get_connection()
+        message.send()
+
+
+def _claim(batch_size):
+    """
+    Mark a batch of due messages as being sent, in a short transaction. Messages a crashed worker
+    left in SENDING are due again after MAIL_CLAIM_TIMEOUT
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        # concurrent flushes take different rows
+        emails = list(OutboundEmail.objects.select_for_update(skip_locked=True)
+                      .filter(status=OutboundEmail.PENDING, next_attempt_at__lte=now)
+                      .order_by('next_attempt_at')[:batch_size])
+        if len(emails) < batch_size:
+            stale = now - datetime.timedelta(seconds=settings.MAIL_CLAIM_TIMEOUT)
+            emails += (OutboundEmail.objects.select_for_update(skip_locked=True)
+                       .filter(status=OutboundEmail.SENDING, claimed_at__lt=stale)
+                       .order_by('claimed_at')[:batch_size - len(emails)])
+        OutboundEmail.objects.filter(pk__in=[email.pk for email in emails]).update(
+            status=OutboundEmail.SENDING, claimed_at=now)
+    return emails
+
+
+def flush(batch_size=None):
+    """
+    Send the due messages in batches over the worker's connection, failures are retried
+    with exponential backoff up to MAIL_MAX_ATTEMPTS. No row is locked while the SMTP server
+    is talked to. Returns the number of sent messages
+    """
+    cache.delete(FLUSH_SCHEDULED)
+    batch_size = batch_size or settings.MAIL_BATCH_SIZE
+    sent = 0
+    while emails := _claim(batch_size):
+        for email in emails:
+            email.attempts += 1
+            try:
+                _send(email)
+            except Exception as error:
+                logger.warning('Sending email %s to %s failed: %s', email.id, email.to, error)
+                _reset_connection()
+                email.last_error = str(error)[:500]
+                if email.attempts >= settings.MAIL_MAX_ATTEMPTS:
+                    email.status = OutboundEmail.FAILED
+                    _count('failed')
+                else:
+                    email.status = OutboundEmail.PENDING
+                    email.next_attempt_at = timezone.now() + datetime.timedelta(
+                        seconds=settings.MAIL_RETRY_BACKOFF * 2 ** (email.attempts - 1))
+                    _count('retried')
+            else:
+                email.status = OutboundEmail.SENT
+                email.sent_at = timezone.now()
+                sent += 1
+                _count('sent')
+        OutboundEmail.objects.bulk_update(
+            emails, ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at'])
+    return sent
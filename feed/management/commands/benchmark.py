@@ -0,0 +1,41 @@
+import json
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from feed import benchmark
+from feed.models import Post
+
+
+class Command(BaseCommand):
+    help = ('Seed a graded dataset in a separate test database and record latency percentiles, '
+            'query counts and rendered bytes of the hot endpoints into a JSON baseline')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dataset', choices=benchmark.DATASETS, default='1k')
+        parser.add_argument('--requests', type=int, default=50, help='Measured requests per endpoint')
+        parser.add_argument('--processes', type=int, default=1, help='Passed to seed_data')
+        parser.add_argument('--output', default='benchmark.json')
+        parser.add_argument('--keepdb', action='store_true',
+                            help='Keep the seeded test database, and reuse it on the next run')
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            if not Post.objects.exists():
+                self.stdout.write(f"Seeding the {options['dataset']} dataset...")
+                call_command('seed_data', prefix='bench', processes=options['processes'], seed=0,
+                             stdout=self.stdout, **benchmark.DATASETS[options['dataset']])
+            results = benchmark.run(requests=options['requests'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+
+        results['meta']['dataset'] = options['dataset']
+        with open(options['output'], 'w') as file:
+            json.dump(results, file, indent=2)
+        for name, result in results['endpoints'].items():
+            self.stdout.write(f"{name:>14}: p50 {result['p50_ms']:>9.2f} ms  p95 {result['p95_ms']:>9.2f} ms  "
+                              f"queries {result['queries_max']:>4}  {result['bytes_mean']:>8} bytes")
+        self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
@@ -0,0 +1,25 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from feed import benchmark
+
+
+class Command(BaseCommand):
+    help = 'Diff two benchmark JSON files and fail when an endpoint got slower or issues more queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('baseline')
+        parser.add_argument('current')
+        parser.add_argument('--threshold', type=float, default=0.1,
+                            help='Allowed relative slowdown of the timings, 0.1 is 10%%')
+
+    def handle(self, *args, **options):
+        with open(options['baseline']) as baseline, open(options['current']) as current:
+            rows, regressed = benchmark.compare(json.load(baseline), json.load(current), options['threshold'])
+        for name, field, old, new, change, worse in rows:
+            line = f'{name:>14} {field:>14}: {old:>10} -> {new:>10} ({change:+.1%})'
+            self.stdout.write(self.style.ERROR(line) if worse else line)
+        if regressed:
+            raise CommandError('Performance regression against the baseline')
+        self.stdout.write(self.style.SUCCESS('No regressions'))
@@ -0,0 +1,103 @@
+import random
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db import models
+from django.db.models import F
+
+from feed.models import Follower, Like, Post, TimelineEntry, User, Profile
+
+INDEXED_MODELS = (Post, Follower, Like, TimelineEntry)
+
+# the single-column foreign key indexes of the schema before the feed indexes, which replaced them
+BASELINE_INDEXES = (
+    (Post, models.Index(fields=['user'], name='explain_post_user')),
+    (Like, models.Index(fields=['user'], name='explain_like_user')),
+    (Like, models.Index(fields=['post'], name='explain_like_post')),
+    (Follower, models.Index(fields=['follower'], name='explain_follower_follower')),
+)
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Seed a throwaway dataset and print EXPLAIN plans of the feed, like and follow queries '
+            'with the baseline foreign key indexes and with the feed indexes. Everything is rolled back at the end')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--posts', type=int, default=50000)
+        parser.add_argument('--follows', type=int, default=50)
+        parser.add_argument('--likes', type=int, default=100000)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('explain_indexes needs PostgreSQL, the indexes are dropped in a transaction')
+        try:
+            with transaction.atomic():
+                user = self.seed(**options)
+                with connection.schema_editor() as schema_editor:
+                    for model in INDEXED_MODELS:
+                        for index in model._meta.indexes:
+                            schema_editor.remove_index(model, index)
+                    for model, index in BASELINE_INDEXES:
+                        schema_editor.add_index(model, index)
+                self.analyze()
+                self.explain('WITH baseline foreign key indexes', user)
+                with connection.schema_editor() as schema_editor:
+                    for model, index in BASELINE_INDEXES:
+                        schema_editor.remove_index(model, index)
+                    for model in INDEXED_MODELS:
+                        for index in model._meta.indexes:
+                            schema_editor.add_index(model, index)
+                self.analyze()
+                self.explain('WITH feed indexes', user)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def seed(self, users, posts, follows, likes, **options):
+        self.stdout.write(f'Seeding {users} users, {posts} posts, ~{users * follows} follows, {likes} likes...')
+        created = User.objects.bulk_create(
+            User(username=f'explain_{number}', email=f'explain_{number}@example.com') for number in range(users))
+        Profile.objects.bulk_create(Profile(user=user, slug=user.username) for user in created)
+        Follower.objects.bulk_create(Follower(follower=user, following=user) for user in created)
+        Follower.objects.bulk_create(
+            (Follower(follower=user, following=following)
+             for user in created for following in random.sample(created, min(follows, users)) if following != user),
+            batch_size=5000, ignore_conflicts=True)
+        posts = Post.objects.bulk_create((Post(user=random.choice(created), text='explain') for _ in range(posts)),
+                                         batch_size=5000)
+        Like.objects.bulk_create((Like(user=random.choice(created), post=random.choice(posts)) for _ in range(likes)),
+                                 batch_size=5000, ignore_conflicts=True)
+        user = created[0]
+        following = set(Follower.objects.filter(follower=user).values_list('following_id', flat=True))
+        TimelineEntry.objects.bulk_create(
+            (TimelineEntry(user=user, post=post, pub_date=post.pub_date) for post in posts
+             if post.user_id in following),
+            batch_size=5000)
+        return user
+
+    def analyze(self):
+        with connection.cursor() as cursor:
+            for model in INDEXED_MODELS:
+                cursor.execute(f'ANALYZE {connection.ops.quote_name(model._meta.db_table)}')
+
+    def explain(self, title, user):
+        post = Post.objects.filter(user=user).first() or Post.objects.first()
+        queries = {
+            'profile posts': Post.objects.filter(user=user).order_by('-pub_date', '-id')[:21],
+            'home timeline': TimelineEntry.objects.filter(user=user).values_list('pub_date', 'post_id')[:21],
+            'followers list': Follower.objects.filter(following=user).exclude(follower=F('following'))
+                                              .order_by('-id').values_list('follower_id')[:51],
+            'followings list': Follower.objects.filter(follower=user).exclude(follower=F('following'))
+                                               .order_by('-id').values_list('following_id')[:51],
+            'likes of a post': Like.objects.filter(post=post).values_list('user_id'),
+            'is liked by viewer': Like.objects.filter(post=post, user=user),
+        }
+        self.stdout.write(self.style.MIGRATE_HEADING(f'\n=== {title} ==='))
+        for name, queryset in queries.items():
+            self.stdout.write(self.style.MIGRATE_LABEL(f'\n-- {name}'))
+            self.stdout.write(queryset.explain(analyze=True))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from feed import tags
+from feed.models import Post
+
+
+class Command(BaseCommand):
+    help = 'Re-extract the hashtags and mentions of all posts, streaming them in chunks of --batch-size'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        last_id = 0
+        indexed = 0
+        # keyset over the primary key: every chunk is one short query, nothing is held between chunks
+        while posts := list(Post.objects.filter(pk__gt=last_id).order_by('pk')
+                            .values_list('id', 'text', 'pub_date')[:options['batch_size']]):
+            tags.index_posts(posts)
+            indexed += len(posts)
+            last_id = posts[-1][0]
+            self.stdout.write(f'{indexed} posts...')
+        self.stdout.write(self.style.SUCCESS(f'Tags extracted from {indexed} posts'))
@@ -0,0 +1,35 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from feed import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Measure the throughput of a running server at high concurrency, e.g. once under '
+            '"gunicorn djangogramm_15.wsgi --threads 32" and once under '
+            '"uvicorn djangogramm_15.asgi:application" with FEED_ASYNC_VIEWS=True, both on the same seeded database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', help='Base url of the server, e.g. http://127.0.0.1:8000')
+        parser.add_argument('--requests', type=int, default=1000, help='Requests per endpoint')
+        parser.add_argument('--concurrency', type=int, default=100, help='Concurrent clients')
+        parser.add_argument('--output', default='load.json')
+        parser.add_argument('--compare', help='JSON of an earlier run, e.g. the WSGI one, to print the speedup against')
+
+    def handle(self, *args, **options):
+        results = benchmark.load(options['url'], requests=options['requests'], concurrency=options['concurrency'])
+        with open(options['output'], 'w') as file:
+            json.dump(results, file, indent=2)
+
+        baseline = {}
+        if options['compare']:
+            with open(options['compare']) as file:
+                baseline = json.load(file)['endpoints']
+        for name, result in results['endpoints'].items():
+            line = (f"{name:>8}: {result['requests_per_s']:>9.1f} req/s  p50 {result['p50_ms']:>9.2f} ms  "
+                    f"p99 {result['p99_ms']:>9.2f} ms  errors {result['errors']}")
+            if name in baseline:
+                line += f"  ({result['requests_per_s'] / baseline[name]['requests_per_s']:.2f}x)"
+            self.stdout.write(self.style.ERROR(line) if result['errors'] else line)
+        self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
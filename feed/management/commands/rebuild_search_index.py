@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from feed import search
+
+
+class Command(BaseCommand):
+    help = 'Fill the search vectors of posts and profiles, e.g. after seed_data (PostgreSQL only)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        search.create_indexes()
+        indexed = search.reindex(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'{indexed} rows indexed'))
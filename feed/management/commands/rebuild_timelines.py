@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from feed import timeline
+from feed.models import User
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the precomputed home timelines from the follow graph'
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*', help='Rebuild only these users (default: everybody)')
+
+    def handle(self, *args, **options):
+        users = User.objects.all()
+        if options['usernames']:
+            users = users.filter(username__in=options['usernames'])
+        for count, user in enumerate(users.iterator(), start=1):
+            timeline.rebuild(user)
+            if count % 1000 == 0:
+                self.stdout.write(f'{count} timelines rebuilt...')
+        self.stdout.write(self.style.SUCCESS('Timelines rebuilt'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from feed import counters
+
+
+class Command(BaseCommand):
+    help = 'Recount like, follower and following counters that drifted from the source tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        fixed = counters.reconcile(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'{fixed} rows reconciled'))
@@ -0,0 +1,192 @@
+import datetime
+import random
+from io import BytesIO
+from itertools import accumulate, islice
+from multiprocessing import Pool
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.utils import timezone
+from faker import Faker
+from PIL import Image, ImageDraw
+
+from feed import counters, ranking, search
+from feed.models import Follower, Like, Photo, Post, Profile, TimelineEntry, User
+
+PLACEHOLDER_PATH = 'feed/placeholders'
+
+
+def power_law_weights(size, exponent):
+    """
+    Cumulative Zipf weights: a few very active/popular accounts and a long tail
+    """
+    return list(accumulate(1 / rank ** exponent for rank in range(1, size + 1)))
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def make_placeholders(count, width, height, prefix):
+    """
+    Local images shared by every seeded row, no network and one storage write per file
+    """
+    names = []
+    for number in range(count):
+        image = Image.new('RGB', (width, height), tuple(random.randrange(256) for _ in range(3)))
+        ImageDraw.Draw(image).ellipse(
+            (width // 4, height // 4, width * 3 // 4, height * 3 // 4),
+            fill=tuple(random.randrange(256) for _ in range(3)))
+        buffer = BytesIO()
+        image.save(buffer, 'JPEG', quality=80)
+        names.append(default_storage.save(f'{PLACEHOLDER_PATH}/{prefix}_{number}.jpg',
+                                          ContentFile(buffer.getvalue())))
+    return names
+
+
+def seed_posts(job):
+    """
+    Insert a chunk of posts with their photos and likes, runs in a worker process
+    """
+    (number, chunk, user_ids, activity, photos, likes_per_post, max_photos, days, batch_size, seed) = job
+    if seed is not None:
+        random.seed(seed + number)
+        Faker.seed(seed + number)
+    fake = Faker()
+    start = timezone.now() - datetime.timedelta(days=days)
+
+    # keep the generated dates instead of "now"
+    pub_date = Post._meta.get_field('pub_date')
+    pub_date.auto_now_add = False
+    try:
+        for posts in batched(range(chunk), batch_size):
+            authors = random.choices(user_ids, cum_weights=activity, k=len(posts))
+            # a heavy tail of viral posts, averaging likes_per_post
+            likers = [set(random.choices(
+                user_ids, cum_weights=activity,
+                k=min(round(random.paretovariate(1.5) * likes_per_post / 3), len(user_ids))))
+                for _ in posts]
+            dates = [start + datetime.timedelta(seconds=random.uniform(0, days * 86400)) for _ in posts]
+            created = Post.objects.bulk_create(
+                Post(user_id=author, text=fake.sentence(nb_words=12), pub_date=date,
+                     like_count=len(liked), ranked_likes=len(liked), rank_score=ranking.base_score(len(liked), date))
+                for author, date, liked in zip(authors, dates, likers))
+
+            Photo.objects.bulk_create(
+                (Photo(post=post, user_id=post.user_id, photo=random.choice(photos))
+                 for post in created for _ in range(random.randint(0, max_photos))),
+                batch_size=batch_size)
+
+            likes = (Like(post=post, user_id=user_id) for post, liked in zip(created, likers) for user_id in liked)
+            for batch in batched(likes, batch_size):
+                Like.objects.bulk_create(batch, ignore_conflicts=True)
+    finally:
+        pub_date.auto_now_add = True
+    return chunk
+
+
+class Command(BaseCommand):
+    help = 'Generate a synthetic dataset with power-law activity, popularity and engagement'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--posts', type=int, default=10000)
+        parser.add_argument('--follows', type=int, default=50, help='Average followings per user')
+        parser.add_argument('--likes', type=int, default=10, help='Average likes per post')
+        parser.add_argument('--max-photos', type=int, default=3)
+        parser.add_argument('--placeholders', type=int, default=20, help='Distinct placeholder images')
+        parser.add_argument('--days', type=int, default=365, help='Spread posts over that many days')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--processes', type=int, default=1)
+        parser.add_argument('--prefix', default='seed', help='Username prefix of the generated users')
+        parser.add_argument('--exponent', type=float, default=1.1, help='Zipf exponent of the distributions')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--skip-timelines', action='store_true')
+
+    def handle(self, *args, **options):
+        if options['seed'] is not None:
+            random.seed(options['seed'])
+            Faker.seed(options['seed'])
+        fake = Faker()
+        batch_size = options['batch_size']
+
+        self.stdout.write('Generating placeholder images...')
+        photos = make_placeholders(options['placeholders'], 600, 400, 'photo')
+        avatars = make_placeholders(max(1, options['placeholders'] // 4), 150, 150, 'avatar')
+
+        self.stdout.write(f"Creating {options['users']} users...")
+        password = make_password(None)
+        user_ids = []
+        for numbers in batched(range(options['users']), batch_size):
+            users = User.objects.bulk_create(
+                User(username=f"{options['prefix']}{number}", email=f"{options['prefix']}{number}@example.com",
+                     password=password)
+                for number in numbers)
+            Profile.objects.bulk_create(
+                Profile(user=user, slug=user.username, full_name=fake.name(), bio=fake.sentence(),
+                        avatar=random.choice(avatars))
+                for user in users)
+            # the self-follow rows signals.create_profile would have made
+            Follower.objects.bulk_create(Follower(follower=user, following=user) for user in users)
+            user_ids.extend(user.id for user in users)
+
+        # popularity decides who gets followed, activity who posts and likes; independent rankings
+        popularity = power_law_weights(len(user_ids), options['exponent'])
+        activity = power_law_weights(len(user_ids), options['exponent'])
+        by_activity = random.sample(user_ids, len(user_ids))
+
+        self.stdout.write('Creating follows...')
+        follows = (Follower(follower_id=follower, following_id=following)
+                   for follower in user_ids
+                   for following in set(random.choices(
+                       user_ids, cum_weights=popularity,
+                       k=min(int(random.expovariate(1 / options['follows'])), len(user_ids))))
+                   if following != follower)
+        for batch in batched(follows, batch_size):
+            Follower.objects.bulk_create(batch, ignore_conflicts=True)
+
+        self.stdout.write(f"Creating {options['posts']} posts with photos and likes...")
+        processes = max(1, options['processes'])
+        chunks = [options['posts'] // processes + (1 if number < options['posts'] % processes else 0)
+                  for number in range(processes)]
+        jobs = [(number, chunk, by_activity, activity, photos, options['likes'], options['max_photos'],
+                 options['days'], batch_size, options['seed']) for number, chunk in enumerate(chunks)]
+        if processes == 1:
+            seed_posts(jobs[0])
+        else:
+            # every worker opens its own database connection
+            connections.close_all()
+            with Pool(processes) as pool:
+                pool.map(seed_posts, jobs)
+
+        self.stdout.write('Reconciling counters...')
+        counters.reconcile(batch_size=batch_size)
+        if not options['skip_timelines']:
+            self.stdout.write('Filling timelines...')
+            self.fill_timelines(options['prefix'])
+        if search.is_postgresql():
+            self.stdout.write('Indexing for search...')
+            search.reindex(batch_size=batch_size)
+        self.stdout.write(self.style.SUCCESS('Done'))
+
+    def fill_timelines(self, prefix):
+        """
+        One INSERT ... SELECT instead of fanning out post by post
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                INSERT INTO {TimelineEntry._meta.db_table} (user_id, post_id, pub_date, score)
+                SELECT follower.follower_id, post.id, post.pub_date, post.rank_score
+                FROM {Post._meta.db_table} post
+                JOIN {Follower._meta.db_table} follower ON follower.following_id = post.user_id
+                JOIN {Profile._meta.db_table} profile ON profile.user_id = post.user_id
+                JOIN {User._meta.db_table} author ON author.id = post.user_id
+                WHERE author.username LIKE %s AND profile.followers_count < %s
+                ON CONFLICT DO NOTHING
+            """, [f'{prefix}%', settings.TIMELINE_CELEBRITY_FOLLOWERS])
@@ -0,0 +1,213 @@
+import logging
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.base import Template
+from django.utils.crypto import constant_time_compare
+from django.utils.functional import SimpleLazyObject
+
+from feed import users
+
+logger = logging.getLogger('feed.instrumentation')
+
+# upper bounds of the latency histogram, in seconds
+BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_recording = ContextVar('feed_instrumentation', default=None)
+
+
+class Recording:
+    """
+    What a single sampled request spent
+    """
+
+    def __init__(self):
+        self.queries = Counter()
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.template_depth = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries[sql] += 1
+
+    def duplicates(self):
+        # the same statement with different parameters is the N+1 pattern
+        return {sql: count for sql, count in self.queries.items()
+                if count >= settings.INSTRUMENTATION_DUPLICATE_THRESHOLD}
+
+
+class Registry:
+    """
+    Totals per URL name since the process started, rendered in the Prometheus text format
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.views = defaultdict(lambda: {
+            'requests': 0, 'seconds': 0.0, 'db_seconds': 0.0, 'template_seconds': 0.0,
+            'queries': 0, 'duplicate_queries': 0, 'buckets': [0] * len(BUCKETS),
+        })
+
+    def add(self, view, total, recording, duplicates):
+        with self.lock:
+            stats = self.views[view]
+            stats['requests'] += 1
+            stats['seconds'] += total
+            stats['db_seconds'] += recording.db_time
+            stats['template_seconds'] += recording.template_time
+            stats['queries'] += sum(recording.queries.values())
+            stats['duplicate_queries'] += sum(count - 1 for count in duplicates.values())
+            for number, bound in enumerate(BUCKETS):
+                if total <= bound:
+                    stats['buckets'][number] += 1
+
+    def render(self):
+        with self.lock:
+            views = {view: {**stats, 'buckets': list(stats['buckets'])} for view, stats in self.views.items()}
+        lines = [
+            f'# sampled requests, sample rate {settings.INSTRUMENTATION_SAMPLE_RATE}',
+            '# TYPE djangogramm_request_seconds histogram',
+        ]
+        for view, stats in views.items():
+            for bound, count in zip(BUCKETS, stats['buckets']):
+                lines.append(f'djangogramm_request_seconds_bucket{{view="{view}",le="{bound}"}} {count}')
+            lines.append(f'djangogramm_request_seconds_bucket{{view="{view}",le="+Inf"}} {stats["requests"]}')
+            lines.append(f'djangogramm_request_seconds_sum{{view="{view}"}} {stats["seconds"]:.6f}')
+            lines.append(f'djangogramm_request_seconds_count{{view="{view}"}} {stats["requests"]}')
+        for metric, field, kind in (('db_seconds_total', 'db_seconds', '.6f'),
+                                    ('template_seconds_total', 'template_seconds', '.6f'),
+                                    ('queries_total', 'queries', 'd'),
+                                    ('duplicate_queries_total', 'duplicate_queries', 'd')):
+            lines.append(f'# TYPE djangogramm_{metric} counter')
+            for view, stats in views.items():
+                lines.append(f'djangogramm_{metric}{{view="{view}"}} {stats[field]:{kind}}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def can_read_metrics(request):
+    if request.user.is_staff:
+        return True
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    return bool(settings.METRICS_TOKEN) and constant_time_compare(token, settings.METRICS_TOKEN)
+
+
+def _render(self, context):
+    recording = _recording.get()
+    if recording is None:
+        return _original_render(self, context)
+    # included templates render inside their parent, only time the outermost one
+    recording.template_depth += 1
+    start = time.perf_counter()
+    try:
+        return _original_render(self, context)
+    finally:
+        recording.template_depth -= 1
+        if not recording.template_depth:
+            recording.template_time += time.perf_counter() - start
+
+
+_original_render = Template.render
+
+
+def _instrument_templates():
+    # only patched in processes that sample, see InstrumentationMiddleware
+    Template.render = _render
+
+
+def _wrap_connections(stack, recording):
+    for connection in connections.all():
+        stack.enter_context(connection.execute_wrapper(recording))
+
+
+class InstrumentationMiddleware:
+    """
+    Record query count, DB time, template time and latency of a sample of the requests.
+    Costs one random() call on the requests that are not sampled, and is left out of the
+    middleware chain while INSTRUMENTATION_SAMPLE_RATE is 0
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.INSTRUMENTATION_SAMPLE_RATE:
+            raise MiddlewareNotUsed
+        _instrument_templates()
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if random.random() >= settings.INSTRUMENTATION_SAMPLE_RATE:
+            return self.get_response(request)
+
+        recording = Recording()
+        token = _recording.set(recording)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                _wrap_connections(stack, recording)
+                response = self.get_response(request)
+        finally:
+            _recording.reset(token)
+        self._report(request, response, recording, time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        if random.random() >= settings.INSTRUMENTATION_SAMPLE_RATE:
+            return await self.get_response(request)
+
+        recording = Recording()
+        token = _recording.set(recording)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                # connections are per thread and the ORM of async views runs in the request's sync thread
+                await sync_to_async(_wrap_connections)(stack, recording)
+                response = await self.get_response(request)
+        finally:
+            _recording.reset(token)
+        self._report(request, response, recording, time.perf_counter() - start)
+        return response
+
+    def _report(self, request, response, recording, total):
+        view = request.resolver_match.view_name if request.resolver_match else 'unresolved'
+        duplicates = recording.duplicates()
+        registry.add(view, total, recording, duplicates)
+        logger.info('%s %s %s total=%.1fms db=%.1fms queries=%d template=%.1fms',
+                    view, request.method, response.status_code, total * 1000, recording.db_time * 1000,
+                    sum(recording.queries.values()), recording.template_time * 1000)
+        for sql, count in duplicates.items():
+            logger.warning('%s ran the same query %d times: %s', view, count, sql)
+
+
+class CachedAuthenticationMiddleware(AuthenticationMiddleware):
+    """
+    request.user and its profile from the cache instead of two queries per request, see feed.users
+    """
+
+    def process_request(self, request):
+        super().process_request(request)
+        request.user = SimpleLazyObject(lambda: users.get_user(request))
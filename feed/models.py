@@ -1,6 +1,10 @@
 from django.contrib.auth.models import AbstractUser
-from django.template.defaultfilters import slugify
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from feed import images
 
 
 class User(AbstractUser):
@@ -12,28 +16,92 @@ class User(AbstractUser):
 
 
 class Profile(models.Model):
+    CHRONOLOGICAL = 'chronological'
+    RANKED = 'ranked'
+    FEED_MODES = [
+        (CHRONOLOGICAL, 'Latest'),
+        (RANKED, 'Top'),
+    ]
+
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     full_name = models.CharField(max_length=50, blank=True)
     avatar = models.ImageField(default='blank_profile_img.png', upload_to='feed/avatars')
+    avatar_variants = models.JSONField(default=dict, blank=True)
     bio = models.TextField(max_length=300, blank=True)
-    slug = models.SlugField(blank=True)
+    # unique among the current and the former slugs, see feed.slugs
+    slug = models.SlugField(unique=True, blank=True)
+    feed_mode = models.CharField(max_length=13, choices=FEED_MODES, default=CHRONOLOGICAL)
+    followers_count = models.PositiveIntegerField(default=0)
+    following_count = models.PositiveIntegerField(default=0)
+    # username, full name and bio, maintained by feed.search on PostgreSQL
+    search_vector = SearchVectorField(null=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def save(self, *args, **kwargs):
-        if not self.id:
-            self.slug = slugify(self.user.username)
+        if not self.id and not self.slug:
+            from feed import slugs
+            self.slug = slugs.unique_slug(self.user.username, self.user_id)
         super().save(*args, **kwargs)
 
+    @property
+    def avatar_thumb_url(self):
+        return images.variant_url(self.avatar, self.avatar_variants, 'thumb')
+
     def __str__(self):
         return f'id={self.id}, full_name={self.full_name}, slug={self.slug}'
 
 
+class SlugHistory(models.Model):
+    """
+    A former slug of a renamed user: old profile links redirect, and the slug is never handed out again
+    """
+    slug = models.SlugField(unique=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='former_slugs')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'id={self.id}, slug={self.slug}, user={self.user_id}'
+
+
+class PostQuerySet(models.QuerySet):
+
+    def for_feed(self, viewer):
+        """
+        Everything a post card renders, fetched in a constant number of queries
+        """
+        return (self.select_related('user__profile')
+                .defer('search_vector', 'user__profile__search_vector')
+                .prefetch_related('photos')
+                .annotate(is_liked_by_viewer=Exists(Like.objects.filter(post=OuterRef('pk'), user=viewer))))
+
+
+# liked or unliked since feed.ranking.rescore last ran, or never ranked
+POSTS_TO_RANK = models.Q(rank_score__isnull=True) | ~models.Q(ranked_likes=models.F('like_count'))
+
+
 class Post(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='posts')
+    # indexed by feed_post_user_date_idx
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='posts', db_index=False)
     text = models.TextField(blank=True, max_length=500)
     pub_date = models.DateTimeField('date published', auto_now_add=True)
+    like_count = models.PositiveIntegerField(default=0)
+    # engagement and recency score of the ranked feed and the like_count it was computed from
+    rank_score = models.FloatField(null=True, blank=True)
+    ranked_likes = models.PositiveIntegerField(default=0)
+    # maintained by feed.search on PostgreSQL
+    search_vector = SearchVectorField(null=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = PostQuerySet.as_manager()
 
     class Meta:
         ordering = ["-pub_date"]
+        indexes = [
+            # profile pages and celebrity posts merged into the feed, paginated on (pub_date, id)
+            models.Index(fields=['user', '-pub_date', '-id'], name='feed_post_user_date_idx'),
+            # only the few rows waiting for the ranking job
+            models.Index(fields=['id'], name='feed_post_to_rank_idx', condition=POSTS_TO_RANK),
+        ]
 
     def __str__(self):
         return f'user={self.user.username}, text={self.text[:30]}, pub_date={self.pub_date}'
@@ -43,28 +111,311 @@ class Photo(models.Model):
     post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='photos')
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     photo = models.ImageField(upload_to='feed/profiles_photos')
+    variants = models.JSONField(default=dict, blank=True)
+
+    @property
+    def webp_srcset(self):
+        return images.srcset(self.photo.storage, self.variants, 'webp')
+
+    @property
+    def jpeg_srcset(self):
+        return images.srcset(self.photo.storage, self.variants, 'jpeg')
+
+    @property
+    def feed_url(self):
+        return images.variant_url(self.photo, self.variants, 'feed')
+
+    @property
+    def full_url(self):
+        return images.variant_url(self.photo, self.variants, 'full')
 
     def __str__(self):
         return f'photo_id={self.id}'
 
 
 class Follower(models.Model):
-    follower = models.ForeignKey(User, related_name="followings", on_delete=models.CASCADE, null=True)
+    # indexed by the unique_together index
+    follower = models.ForeignKey(User, related_name="followings", on_delete=models.CASCADE, null=True,
+                                 db_index=False)
     following = models.ForeignKey(User, related_name="followers", on_delete=models.CASCADE, null=True)
 
     class Meta:
         unique_together = ('follower', 'following')
+        indexes = [
+            # followers/followings lists without the self-follow rows, index-only scans on PostgreSQL
+            models.Index(fields=['following', '-id'], include=['follower'], name='feed_followers_list_idx',
+                         condition=~models.Q(follower=models.F('following'))),
+            models.Index(fields=['follower', '-id'], include=['following'], name='feed_followings_list_idx',
+                         condition=~models.Q(follower=models.F('following'))),
+        ]
 
     def __str__(self):
         return f'id={self.id}, follower={self.follower}, following={self.following}'
 
 
 class Like(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='likes')
-    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='likes')
+    # indexed by the unique_together index and feed_like_post_user_idx
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='likes', db_index=False)
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='likes', db_index=False)
 
     class Meta:
         unique_together = ('user', 'post')
+        indexes = [
+            # likes of a post, e.g. recounting like_count
+            models.Index(fields=['post', 'user'], name='feed_like_post_user_idx'),
+        ]
 
     def __str__(self):
         return f'id={self.id}, user={self.user}, post={self.post}'
+
+
+class LikeDelta(models.Model):
+    """
+    A buffered like_count change, appended instead of updating the hot post row, see counters.flush_likes
+    """
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='like_deltas')
+    delta = models.SmallIntegerField()
+
+    def __str__(self):
+        return f'id={self.id}, post={self.post_id}, delta={self.delta}'
+
+
+class Suggestion(models.Model):
+    """
+    A precomputed "who to follow" candidate, refreshed by feed.tasks.refresh_suggestions
+    """
+    FRIENDS = 'friends'
+    LIKES = 'likes'
+    POPULAR = 'popular'
+    REASONS = [
+        (FRIENDS, 'Followed by people you follow'),
+        (LIKES, 'You like their posts'),
+        (POPULAR, 'Popular'),
+    ]
+
+    # indexed by the unique_together index
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='suggestions', db_index=False)
+    suggested = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+    reason = models.CharField(max_length=10, choices=REASONS)
+
+    class Meta:
+        ordering = ['-score']
+        unique_together = ('user', 'suggested')
+        indexes = [
+            models.Index(fields=['user', '-score'], name='feed_suggestion_user_score_idx'),
+        ]
+
+    def __str__(self):
+        return f'id={self.id}, user={self.user_id}, suggested={self.suggested_id}, score={self.score}'
+
+
+class Tag(models.Model):
+    # lowercase, without the #
+    name = models.CharField(max_length=50, unique=True)
+
+    def __str__(self):
+        return f'id={self.id}, name={self.name}'
+
+
+class PostTag(models.Model):
+    """
+    Inverted index from a tag to its posts, pub_date is copied so a tag page is one index range scan
+    """
+    # indexed by feed_posttag_tag_date_idx and the unique_together index
+    tag = models.ForeignKey(Tag, on_delete=models.CASCADE, related_name='post_tags', db_index=False)
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='post_tags', db_index=False)
+    pub_date = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('post', 'tag')
+        indexes = [
+            models.Index(fields=['tag', '-pub_date', '-post'], name='feed_posttag_tag_date_idx'),
+        ]
+
+    def __str__(self):
+        return f'id={self.id}, tag={self.tag_id}, post={self.post_id}'
+
+
+class Mention(models.Model):
+    # indexed by feed_mention_user_date_idx and the unique_together index
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='mentions', db_index=False)
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='mentions', db_index=False)
+    pub_date = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('post', 'user')
+        indexes = [
+            models.Index(fields=['user', '-pub_date', '-post'], name='feed_mention_user_date_idx'),
+        ]
+
+    def __str__(self):
+        return f'id={self.id}, user={self.user_id}, post={self.post_id}'
+
+
+class AccountExport(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Ready'),
+        (FAILED, 'Failed'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='exports')
+    status = models.CharField(max_length=7, choices=STATUSES, default=PENDING)
+    archive = models.FileField(upload_to='feed/exports', blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f'id={self.id}, user={self.user_id}, status={self.status}'
+
+
+class ConfirmedUpload(models.Model):
+    """
+    The storage key of a direct upload once attached, an upload token is only confirmed once
+    """
+    key = models.CharField(max_length=255, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'id={self.id}, key={self.key}'
+
+
+class OutboundEmail(models.Model):
+    """
+    A queued message, sent in batches by feed.mail.flush
+    """
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUSES = [
+        (PENDING, 'Pending'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    ]
+
+    to = models.EmailField()
+    from_email = models.CharField(max_length=254)
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    html_body = models.TextField(blank=True)
+    status = models.CharField(max_length=7, choices=STATUSES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.CharField(max_length=500, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    # when a flush took the message for sending, see feed.mail.flush
+    claimed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # only the queue itself, sent messages stay out of the index
+            models.Index(fields=['next_attempt_at'], name='feed_outboundemail_due_idx',
+                         condition=models.Q(status='pending')),
+            models.Index(fields=['claimed_at'], name='feed_outboundemail_claimed_idx',
+                         condition=models.Q(status='sending')),
+        ]
+
+    def __str__(self):
+        return f'id={self.id}, to={self.to}, status={self.status}'
+
+
+class NotificationEvent(models.Model):
+    """
+    A like or a follow waiting to be folded into a Notification by feed.notifications.aggregate
+    """
+    LIKE = 'like'
+    FOLLOW = 'follow'
+    KINDS = [
+        (LIKE, 'Like'),
+        (FOLLOW, 'Follow'),
+    ]
+
+    recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', db_index=False)
+    actor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', db_index=False)
+    kind = models.CharField(max_length=6, choices=KINDS)
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='+', null=True, blank=True,
+                             db_index=False)
+
+    def __str__(self):
+        return f'id={self.id}, recipient={self.recipient_id}, actor={self.actor_id}, kind={self.kind}'
+
+
+class Notification(models.Model):
+    """
+    All the likes of a post, or all the follows, since the recipient last read the inbox
+    """
+    # indexed by feed_notification_inbox_idx and feed_notification_unread_group
+    recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications', db_index=False)
+    kind = models.CharField(max_length=6, choices=NotificationEvent.KINDS)
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='+', null=True, blank=True)
+    # 'like:<post id>' or 'follow', events of the same group and recipient are aggregated while unread
+    group = models.CharField(max_length=30)
+    last_actor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    actor_count = models.PositiveIntegerField(default=1)
+    is_read = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['-updated_at', '-id']
+        indexes = [
+            models.Index(fields=['recipient', '-updated_at', '-id'], name='feed_notification_inbox_idx'),
+        ]
+        constraints = [
+            # one open group per recipient, also serves the unread count
+            models.UniqueConstraint(fields=['recipient', 'group'], condition=models.Q(is_read=False),
+                                    name='feed_notification_unread_group'),
+        ]
+
+    @property
+    def others_count(self):
+        return self.actor_count - 1
+
+    def __str__(self):
+        return f'id={self.id}, recipient={self.recipient_id}, group={self.group}, actors={self.actor_count}'
+
+
+class NotificationActor(models.Model):
+    """
+    An actor already counted in a notification, a relike or a refollow is not counted twice
+    """
+    # indexed by the unique_together index
+    notification = models.ForeignKey(Notification, on_delete=models.CASCADE, related_name='actors', db_index=False)
+    actor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        unique_together = ('notification', 'actor')
+
+    def __str__(self):
+        return f'id={self.id}, notification={self.notification_id}, actor={self.actor_id}'
+
+
+class TimelineEntry(models.Model):
+    # indexed by feed_timeline_user_date_idx and feed_timeline_user_score_idx
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='timeline', db_index=False)
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='timeline_entries')
+    pub_date = models.DateTimeField()
+    # the post's rank_score plus the user's affinity to its author, see feed.ranking
+    score = models.FloatField(default=0)
+
+    class Meta:
+        ordering = ['-pub_date', '-post_id']
+        unique_together = ('user', 'post')
+        indexes = [
+            models.Index(fields=['user', '-pub_date', '-post'], name='feed_timeline_user_date_idx'),
+            models.Index(fields=['user', '-score', '-post'], name='feed_timeline_user_score_idx'),
+        ]
+
+    def __str__(self):
+        return f'id={self.id}, user={self.user_id}, post={self.post_id}'
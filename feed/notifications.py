@@ -0,0 +1,126 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.utils import timezone
+
+from feed.models import Notification, NotificationActor, NotificationEvent
+from feed.pagination import KeysetPaginator
+
+# pg_advisory_xact_lock key of feed.notifications.aggregate, any bigint no other job uses
+AGGREGATION_LOCK = 0x6e6f7469667931
+
+
+def _unread_key(user_id):
+    return f'notifications:unread:{user_id}'
+
+
+def _group(kind, post_id):
+    return f'{kind}:{post_id}' if kind == NotificationEvent.LIKE else kind
+
+
+def record(kind, recipient_id, actor_id, post_id=None):
+    """
+    Stage an event for the next aggregation, a single insert on the like or follow request
+    """
+    if recipient_id != actor_id:
+        NotificationEvent.objects.create(kind=kind, recipient_id=recipient_id, actor_id=actor_id, post_id=post_id)
+
+
+def _fold(events):
+    groups = {}
+    for event in events:
+        group = groups.setdefault((event.recipient_id, _group(event.kind, event.post_id)),
+                                  {'kind': event.kind, 'post_id': event.post_id, 'actors': []})
+        group['actors'].append(event.actor_id)
+
+    open_groups = {
+        (notification.recipient_id, notification.group): notification
+        for notification in Notification.objects.select_for_update().filter(
+            recipient_id__in={recipient_id for recipient_id, _ in groups},
+            group__in={name for _, name in groups}, is_read=False)
+    }
+    counted = set(NotificationActor.objects.filter(
+        notification__in=open_groups.values(),
+        actor_id__in={actor_id for group in groups.values() for actor_id in group['actors']},
+    ).values_list('notification_id', 'actor_id'))
+    now = timezone.now()
+    updated, created, actors = [], [], []
+    for (recipient_id, name), group in groups.items():
+        notification = open_groups.get((recipient_id, name))
+        if notification is None:
+            new_actors = list(dict.fromkeys(group['actors']))
+            notification = Notification(recipient_id=recipient_id, kind=group['kind'], post_id=group['post_id'],
+                                        group=name, last_actor_id=new_actors[-1], actor_count=len(new_actors),
+                                        updated_at=now)
+            created.append(notification)
+        else:
+            new_actors = [actor_id for actor_id in dict.fromkeys(group['actors'])
+                          if (notification.id, actor_id) not in counted]
+            if not new_actors:
+                continue  # unliked and liked again, unfollowed and followed again
+            notification.actor_count += len(new_actors)
+            notification.last_actor_id = new_actors[-1]
+            notification.updated_at = now
+            updated.append(notification)
+        actors.extend((notification, actor_id) for actor_id in new_actors)
+    Notification.objects.bulk_update(updated, ['actor_count', 'last_actor', 'updated_at'])
+    Notification.objects.bulk_create(created)
+    NotificationActor.objects.bulk_create(NotificationActor(notification_id=notification.id, actor_id=actor_id)
+                                          for notification, actor_id in actors)
+
+
+def _try_lock():
+    """
+    Whether the current transaction got the aggregation lock, held until it ends. It is the database's,
+    so runs on other workers see it too. SQLite has one writer at a time anyway
+    """
+    if connection.vendor != 'postgresql':
+        return True
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_xact_lock(%s)', [AGGREGATION_LOCK])
+        return cursor.fetchone()[0]
+
+
+def aggregate(batch_size=None):
+    """
+    Fold the staged events into the open notification of their group, "alice and 40 others liked
+    your post" is one row. Returns the number of folded events
+    """
+    batch_size = batch_size or settings.NOTIFICATIONS_BATCH_SIZE
+    folded = 0
+    while True:
+        with transaction.atomic():
+            # concurrent runs would both open the same group, a batch is read and folded under the lock
+            if not _try_lock():
+                return folded
+            events = list(NotificationEvent.objects.order_by('pk')[:batch_size])
+            if not events:
+                return folded
+            _fold(events)
+            NotificationEvent.objects.filter(pk__in=[event.pk for event in events]).delete()
+        cache.delete_many([_unread_key(recipient_id) for recipient_id in {event.recipient_id for event in events}])
+        folded += len(events)
+
+
+def unread_count(user_id):
+    """
+    Cached until the next aggregation or read for the user, cheap enough for every page
+    """
+    key = _unread_key(user_id)
+    count = cache.get(key)
+    if count is None:
+        count = Notification.objects.filter(recipient_id=user_id, is_read=False).count()
+        cache.set(key, count, settings.NOTIFICATIONS_UNREAD_TIMEOUT)
+    return count
+
+
+def mark_read(user_id):
+    Notification.objects.filter(recipient_id=user_id, is_read=False).update(is_read=True)
+    cache.delete(_unread_key(user_id))
+
+
+def inbox(user, cursor=None):
+    notifications = (Notification.objects.filter(recipient=user)
+                     .select_related('last_actor__profile', 'post').defer('post__search_vector'))
+    return KeysetPaginator(notifications, keys=('-updated_at', '-id'),
+                           per_page=settings.NOTIFICATIONS_PAGE_SIZE).page(cursor)
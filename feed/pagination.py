@@ -0,0 +1,134 @@
+import base64
+import binascii
+import datetime
+import json
+from functools import reduce
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+from django.http import Http404
+
+
+def _default(value):
+    # full isoformat, DjangoJSONEncoder would cut datetimes to milliseconds and break the keyset
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not cursor serializable')
+
+
+def encode_cursor(values):
+    data = json.dumps(list(values), default=_default, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, fields):
+    """
+    The key values of a cursor, converted by the model fields of the keys. A tampered cursor is a 404
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise Http404('Invalid cursor')
+    if not isinstance(values, list) or len(values) != len(fields):
+        raise Http404('Invalid cursor')
+    try:
+        values = [field.to_python(value) for field, value in zip(fields, values)]
+    except (ValidationError, ValueError, TypeError):
+        raise Http404('Invalid cursor')
+    # the keys are not nullable, a null would compare to nothing
+    if any(value is None for value in values):
+        raise Http404('Invalid cursor')
+    return values
+
+
+def key_fields(queryset, keys):
+    """
+    The model fields (or annotation output fields) of ordering keys, e.g. ('-pub_date', '-id')
+    """
+    fields = []
+    for key in keys:
+        name = key.lstrip('-')
+        try:
+            fields.append(queryset.model._meta.get_field(name))
+        except FieldDoesNotExist:
+            fields.append(queryset.query.annotations[name].output_field)
+    return fields
+
+
+def keyset_filter(keys, values):
+    """
+    Rows strictly after `values` in the order given by `keys`, e.g. ('-pub_date', '-id')
+    """
+    conditions = []
+    for position, key in enumerate(keys):
+        name = key.lstrip('-')
+        lookup = 'lt' if key.startswith('-') else 'gt'
+        equal = {keys[prev].lstrip('-'): values[prev] for prev in range(position)}
+        conditions.append(Q(**equal, **{f'{name}__{lookup}': values[position]}))
+    return reduce(lambda left, right: left | right, conditions)
+
+
+async def alist(queryset):
+    """
+    Evaluate a queryset from a coroutine
+    """
+    return [obj async for obj in queryset]
+
+
+class KeysetPage:
+
+    def __init__(self, object_list, next_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator:
+    """
+    Cursor pagination over a unique ordering, the cost of a page doesn't depend on its depth
+    """
+
+    def __init__(self, queryset, keys=('-pub_date', '-id'), per_page=None):
+        self.queryset = queryset
+        self.keys = keys
+        self.per_page = per_page or settings.FEED_PAGE_SIZE
+
+    def _key_values(self, obj):
+        values = []
+        for key in self.keys:
+            name = key.lstrip('-')
+            try:
+                name = self.queryset.model._meta.get_field(name).attname
+            except FieldDoesNotExist:
+                pass  # annotation
+            values.append(getattr(obj, name))
+        return values
+
+    def _slice(self, cursor):
+        queryset = self.queryset.order_by(*self.keys)
+        if cursor:
+            queryset = queryset.filter(keyset_filter(self.keys, decode_cursor(cursor, key_fields(queryset, self.keys))))
+        return queryset[:self.per_page + 1]
+
+    def _cut(self, object_list):
+        next_cursor = None
+        if len(object_list) > self.per_page:
+            object_list = object_list[:self.per_page]
+            next_cursor = encode_cursor(self._key_values(object_list[-1]))
+        return KeysetPage(object_list, next_cursor)
+
+    def page(self, cursor=None):
+        return self._cut(list(self._slice(cursor)))
+
+    async def apage(self, cursor=None):
+        return self._cut(await alist(self._slice(cursor)))
@@ -0,0 +1,88 @@
+import datetime
+import math
+
+from django.conf import settings
+from django.db.models import Count, F
+from django.utils import timezone
+
+from feed import graph
+from feed.models import POSTS_TO_RANK, Like, Post, TimelineEntry
+
+
+def base_score(like_count, pub_date):
+    """
+    Engagement plus recency. Every RANK_HALF_LIFE of age weighs as much as doubling the likes,
+    so the score of a post only changes when it gets likes and never needs a periodic decay pass
+    """
+    return math.log2(1 + like_count) + pub_date.timestamp() / settings.RANK_HALF_LIFE
+
+
+def affinities(author_id, viewer_ids):
+    """
+    {viewer_id: bonus} for how close the viewers are to the author: followed back and liked before
+    """
+    followed_back = graph.followings(author_id)
+    liked = dict(Like.objects.filter(post__user_id=author_id, user_id__in=viewer_ids)
+                 .values_list('user_id').annotate(count=Count('id')).order_by())
+    return {
+        viewer_id: 0.0 if viewer_id == author_id else _affinity(viewer_id in followed_back, liked.get(viewer_id, 0))
+        for viewer_id in viewer_ids
+    }
+
+
+def author_affinities(viewer_id, author_ids):
+    """
+    {author_id: bonus} of one viewer for several authors, affinities the other way around
+    """
+    followers = graph.followers(viewer_id)
+    liked = dict(Like.objects.filter(user_id=viewer_id, post__user_id__in=author_ids)
+                 .values_list('post__user_id').annotate(count=Count('id')).order_by())
+    return {
+        author_id: 0.0 if author_id == viewer_id else _affinity(author_id in followers, liked.get(author_id, 0))
+        for author_id in author_ids
+    }
+
+
+def _affinity(followed_back, likes):
+    return settings.RANK_AFFINITY_MUTUAL * followed_back + settings.RANK_AFFINITY_LIKES * math.log2(1 + likes)
+
+
+def rank_post(post):
+    post.rank_score = base_score(post.like_count, post.pub_date)
+    post.ranked_likes = post.like_count
+    Post.objects.filter(pk=post.pk).update(rank_score=post.rank_score, ranked_likes=post.ranked_likes)
+    return post.rank_score
+
+
+def _shift_entries(post_id, delta, batch_size):
+    """
+    Move the timeline entries of a post by `delta`, a batch of rows per statement
+    """
+    last_id = 0
+    while ids := list(TimelineEntry.objects.filter(post_id=post_id, pk__gt=last_id).order_by('pk')
+                      .values_list('pk', flat=True)[:batch_size]):
+        TimelineEntry.objects.filter(pk__in=ids).update(score=F('score') + delta)
+        last_id = ids[-1]
+
+
+def rescore(batch_size=1000):
+    """
+    Bring the scores of the posts liked or unliked since the last pass up to date, and of the posts
+    never ranked (bulk inserted). Timeline entries carry the viewer affinity on top of the post score,
+    so they move by the same delta, but only for posts within RANK_RESCORE_WINDOW: an older post needs
+    thousands of times the likes to reach the top of a feed again. Returns the number of rescored posts
+    """
+    rescored = 0
+    last_id = 0
+    window_start = timezone.now() - datetime.timedelta(seconds=settings.RANK_RESCORE_WINDOW)
+    while posts := list(Post.objects.filter(POSTS_TO_RANK, pk__gt=last_id).order_by('pk')
+                        .values_list('pk', 'like_count', 'pub_date', 'rank_score')[:batch_size]):
+        for post_id, like_count, pub_date, rank_score in posts:
+            score = base_score(like_count, pub_date)
+            # marked first, an interrupted pass leaves some entries behind instead of moving them twice
+            Post.objects.filter(pk=post_id).update(rank_score=score, ranked_likes=like_count)
+            if pub_date >= window_start:
+                _shift_entries(post_id, score - (rank_score or 0), settings.TIMELINE_BATCH_SIZE)
+        rescored += len(posts)
+        last_id = posts[-1][0]
+    return rescored
@@ -0,0 +1,109 @@
+import heapq
+import math
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+
+from feed import graph
+from feed.models import Follower, Like, Profile, Suggestion, User
+
+# how much one signal is worth, see score()
+WEIGHTS = {
+    Suggestion.FRIENDS: 1.0,  # per person you follow who follows the candidate
+    Suggestion.LIKES: 0.5,  # per post of the candidate you liked
+    Suggestion.POPULAR: 2.0,  # times the log-scaled follower count, 1 for the most followed account
+}
+
+
+def _popular(limit):
+    profiles = list(Profile.objects.filter(followers_count__gt=0).order_by('-followers_count')
+                    .values_list('user_id', 'followers_count')[:limit])
+    if not profiles:
+        return {}
+    top = math.log1p(profiles[0][1])
+    return {user_id: math.log1p(count) / top for user_id, count in profiles}
+
+
+def score(user_ids, popular):
+    """
+    {user_id: {candidate_id: (score, reason)}} for a batch of users, every signal is one
+    aggregate query for the whole batch. The reason is the signal that contributed the most
+    """
+    signals = defaultdict(lambda: defaultdict(lambda: defaultdict(float)))
+
+    # friends of friends: followings of the users the batch follows
+    friends = (Follower.objects.filter(follower__followers__follower_id__in=user_ids)
+               .values_list('follower__followers__follower_id', 'following_id')
+               .annotate(paths=Count('id')).order_by())
+    for user_id, candidate_id, paths in friends.iterator():
+        signals[user_id][candidate_id][Suggestion.FRIENDS] += paths * WEIGHTS[Suggestion.FRIENDS]
+
+    # authors the users keep liking
+    likes = (Like.objects.filter(user_id__in=user_ids)
+             .values_list('user_id', 'post__user_id').annotate(liked=Count('id')).order_by())
+    for user_id, candidate_id, liked in likes.iterator():
+        signals[user_id][candidate_id][Suggestion.LIKES] += liked * WEIGHTS[Suggestion.LIKES]
+
+    for user_id in user_ids:
+        for candidate_id, weight in popular.items():
+            signals[user_id][candidate_id][Suggestion.POPULAR] += weight * WEIGHTS[Suggestion.POPULAR]
+
+    return {
+        user_id: {candidate_id: (sum(parts.values()), max(parts, key=parts.get))
+                  for candidate_id, parts in candidates.items()}
+        for user_id, candidates in signals.items()
+    }
+
+
+def refresh(user_ids, popular=None):
+    """
+    Replace the stored top suggestions of the users
+    """
+    if popular is None:
+        popular = _popular(settings.SUGGESTIONS_POPULAR)
+    followed = defaultdict(set)
+    for follower_id, following_id in Follower.objects.filter(follower_id__in=user_ids).values_list(
+            'follower_id', 'following_id').iterator():
+        followed[follower_id].add(following_id)
+
+    suggestions = []
+    for user_id, candidates in score(user_ids, popular).items():
+        candidates = ((candidate_id, value) for candidate_id, value in candidates.items()
+                      if candidate_id != user_id and candidate_id not in followed[user_id])
+        suggestions += [Suggestion(user_id=user_id, suggested_id=candidate_id, score=value, reason=reason)
+                        for candidate_id, (value, reason) in heapq.nlargest(
+                            settings.SUGGESTIONS_PER_USER, candidates, key=lambda candidate: candidate[1][0])]
+
+    with transaction.atomic():
+        Suggestion.objects.filter(user_id__in=user_ids).delete()
+        Suggestion.objects.bulk_create(suggestions)
+    return len(suggestions)
+
+
+def refresh_all(batch_size=500):
+    popular = _popular(settings.SUGGESTIONS_POPULAR)
+    created = 0
+    last_id = 0
+    while user_ids := list(User.objects.filter(pk__gt=last_id, is_active=True).order_by('pk')
+                           .values_list('pk', flat=True)[:batch_size]):
+        created += refresh(user_ids, popular)
+        last_id = user_ids[-1]
+    return created
+
+
+def for_user(user, limit):
+    """
+    Suggestions to show, without the accounts followed since the last refresh.
+    Until the job has run for a new user, the most followed accounts
+    """
+    followings = graph.followings(user.id)
+    suggestions = [suggestion for suggestion in
+                   Suggestion.objects.filter(user=user).select_related('suggested__profile')[:limit * 2]
+                   if suggestion.suggested_id not in followings][:limit]
+    if suggestions:
+        return [suggestion.suggested for suggestion in suggestions]
+    return [profile.user for profile in
+            Profile.objects.exclude(user=user).exclude(user_id__in=followings)
+            .select_related('user').order_by('-followers_count', 'id')[:limit]]
@@ -0,0 +1,101 @@
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchVector
+from django.db import connection
+from django.db.models import Q, Value
+
+from feed.models import Post, Profile, User
+from feed.pagination import KeysetPaginator
+
+# created after migrate on PostgreSQL only, GIN has no SQLite equivalent, see create_indexes
+INDEXES = (
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    f'CREATE INDEX IF NOT EXISTS feed_post_search_idx ON {Post._meta.db_table} USING gin (search_vector)',
+    f'CREATE INDEX IF NOT EXISTS feed_profile_search_idx ON {Profile._meta.db_table} USING gin (search_vector)',
+    f'CREATE INDEX IF NOT EXISTS feed_user_username_trgm_idx ON {User._meta.db_table} USING gin (username gin_trgm_ops)',
+    # istartswith compares UPPER(username)
+    f'CREATE INDEX IF NOT EXISTS feed_user_username_prefix_idx ON {User._meta.db_table} '
+    f'(UPPER(username::text) text_pattern_ops)',
+)
+
+
+def is_postgresql():
+    return connection.vendor == 'postgresql'
+
+
+def create_indexes(**kwargs):
+    if not is_postgresql():
+        return
+    with connection.cursor() as cursor:
+        for statement in INDEXES:
+            cursor.execute(statement)
+
+
+def _post_vector():
+    return SearchVector('text', config=settings.SEARCH_CONFIG)
+
+
+def _profile_vector(username):
+    return (SearchVector(Value(username), config='simple', weight='A')
+            + SearchVector('full_name', config='simple', weight='A')
+            + SearchVector('bio', config=settings.SEARCH_CONFIG, weight='B'))
+
+
+def index_post(post_id):
+    if is_postgresql():
+        Post.objects.filter(pk=post_id).update(search_vector=_post_vector())
+
+
+def index_profile(user):
+    if is_postgresql():
+        Profile.objects.filter(user=user).update(search_vector=_profile_vector(user.username))
+
+
+def reindex(batch_size=10000):
+    """
+    Fill the vectors of rows written without signals, e.g. by bulk_create. Returns the number of rows
+    """
+    if not is_postgresql():
+        return 0
+    indexed = 0
+    last_id = 0
+    while ids := list(Post.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size]):
+        indexed += Post.objects.filter(pk__in=ids).update(search_vector=_post_vector())
+        last_id = ids[-1]
+    for profile in Profile.objects.select_related('user').only('user__username').iterator(chunk_size=batch_size):
+        index_profile(profile.user)
+        indexed += 1
+    return indexed
+
+
+def _query(text):
+    return SearchQuery(text, search_type='websearch', config=settings.SEARCH_CONFIG)
+
+
+def search_posts(viewer, text, cursor=None):
+    posts = Post.objects.for_feed(viewer)
+    if is_postgresql():
+        posts = posts.filter(search_vector=_query(text))
+    else:
+        posts = posts.filter(text__icontains=text)
+    return KeysetPaginator(posts).page(cursor)
+
+
+def search_profiles(text, cursor=None):
+    """
+    Username prefixes and near misses through the trigram index, names and bios through the search vector.
+    On PostgreSQL each of them is its own index scan of at most SEARCH_CANDIDATES users, only their union
+    is sorted by followers
+    """
+    if is_postgresql():
+        limit = settings.SEARCH_CANDIDATES
+        vector = (Q(search_vector=SearchQuery(text, search_type='websearch', config='simple'))
+                  | Q(search_vector=_query(text)))
+        candidates = (User.objects.filter(username__istartswith=text).values('id')[:limit]
+                      .union(User.objects.filter(username__trigram_similar=text).values('id')[:limit],
+                             Profile.objects.filter(vector).values('user_id')[:limit]))
+        profiles = Profile.objects.filter(user_id__in=candidates)
+    else:
+        profiles = Profile.objects.filter(Q(user__username__istartswith=text) | Q(full_name__icontains=text)
+                                          | Q(bio__icontains=text))
+    return KeysetPaginator(profiles.select_related('user'), keys=('-followers_count', '-id'),
+                           per_page=settings.FOLLOWERS_PAGE_SIZE).page(cursor)
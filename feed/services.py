@@ -0,0 +1,52 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django import forms
+from django.conf import settings
+from django.db import transaction
+
+from feed.models import Photo, Post
+from feed.tasks import process_photo_variants
+
+
+def _upload(field, instance, file):
+    return field.storage.save(field.generate_filename(instance, file.name), file)
+
+
+def upload_photos(user, files):
+    """
+    Send the files to the storage concurrently, S3 puts are network bound
+    """
+    field = Photo._meta.get_field('photo')
+    instance = Photo(user=user)
+    if len(files) < 2:
+        return [_upload(field, instance, file) for file in files]
+    with ThreadPoolExecutor(max_workers=min(len(files), settings.UPLOAD_THREADS)) as executor:
+        return list(executor.map(partial(_upload, field, instance), files))
+
+
+def create_post(user, text, files=(), uploaded_keys=()):
+    """
+    Validate the photos, upload them and write the post with all its photos in one transaction.
+    `uploaded_keys` are confirmed direct uploads (see feed.uploads) that are already in the storage
+    """
+    image_field = forms.ImageField()
+    for file in files:
+        image_field.clean(file)
+    if not text and not files and not uploaded_keys:
+        raise forms.ValidationError('A post needs a text or a photo.', code='empty')
+
+    names = upload_photos(user, files)
+    try:
+        with transaction.atomic():
+            post = Post.objects.create(user=user, text=text)
+            photos = Photo.objects.bulk_create([Photo(post=post, user=user, photo=name)
+                                                for name in [*names, *uploaded_keys]])
+    except Exception:
+        for name in names:
+            Photo._meta.get_field('photo').storage.delete(name)
+        raise
+
+    for photo in photos:
+        transaction.on_commit(partial(process_photo_variants.delay, photo.id))
+    return post
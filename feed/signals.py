@@ -1,7 +1,12 @@
-from django.db.models.signals import post_save
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
+from django.utils import timezone
 
-from feed.models import User, Profile, Follower
+from feed import events, graph, notifications, search, slugs, tags, tasks, timeline, users
+from feed.models import User, Profile, Follower, NotificationEvent, Post, Photo
 
 
 @receiver(post_save, sender=User, dispatch_uid="test_data")
@@ -9,3 +14,99 @@ def create_profile(sender, instance, created, **kwargs):
     if created:
         Profile.objects.create(user=instance)
         Follower.objects.create(follower=instance, following=instance)
+
+
+@receiver(post_save, sender=Post, dispatch_uid="timeline_fan_out")
+def fan_out_post(sender, instance, created, **kwargs):
+    # up to TIMELINE_CELEBRITY_FOLLOWERS rows, written outside the request and its transaction
+    if created:
+        transaction.on_commit(partial(tasks.fan_out_post.delay, instance.id))
+
+
+@receiver(post_save, sender=Post, dispatch_uid="push_new_post")
+def push_new_post(sender, instance, created, **kwargs):
+    if created:
+        events.publish_post(instance)
+
+
+@receiver(post_save, sender=Follower, dispatch_uid="timeline_backfill")
+def backfill_timeline(sender, instance, created, **kwargs):
+    if created:
+        timeline.backfill(instance.follower, instance.following)
+
+
+@receiver(post_save, sender=Follower, dispatch_uid="notify_follow")
+def notify_follow(sender, instance, created, **kwargs):
+    if created:
+        notifications.record(NotificationEvent.FOLLOW, instance.following_id, instance.follower_id)
+
+
+@receiver(post_delete, sender=Follower, dispatch_uid="timeline_purge")
+def purge_timeline(sender, instance, **kwargs):
+    timeline.purge(instance.follower, instance.following)
+
+
+@receiver(post_save, sender=Follower, dispatch_uid="graph_follow")
+@receiver(post_delete, sender=Follower, dispatch_uid="graph_follow")
+def invalidate_graph(sender, instance, **kwargs):
+    graph.invalidate(instance.follower_id, instance.following_id)
+
+
+@receiver(post_save, sender=Post, dispatch_uid="search_post")
+def index_post(sender, instance, created, update_fields=None, **kwargs):
+    if created or update_fields is None or 'text' in update_fields:
+        search.index_post(instance.pk)
+
+
+@receiver(post_save, sender=Post, dispatch_uid="tags_post")
+def index_post_tags(sender, instance, created, update_fields=None, **kwargs):
+    if created or update_fields is None or 'text' in update_fields:
+        tags.index_post(instance)
+
+
+@receiver(post_save, sender=Profile, dispatch_uid="search_profile")
+def index_profile(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or {'full_name', 'bio'} & set(update_fields):
+        search.index_profile(instance.user)
+
+
+@receiver(post_save, sender=User, dispatch_uid="search_username")
+def index_username(sender, instance, created, update_fields=None, **kwargs):
+    # a new user has no profile yet, create_profile indexes it
+    if not created and (update_fields is None or 'username' in update_fields):
+        search.index_profile(instance)
+
+
+@receiver(post_save, sender=User, dispatch_uid="slug_username")
+def rename_slug(sender, instance, created, update_fields=None, **kwargs):
+    if not created and (update_fields is None or 'username' in update_fields):
+        slugs.rename(instance)
+
+
+@receiver(post_save, sender=User, dispatch_uid="cached_user")
+@receiver(post_delete, sender=User, dispatch_uid="cached_user")
+def invalidate_cached_user(sender, instance, **kwargs):
+    users.invalidate(instance.pk)
+
+
+@receiver(post_save, sender=Profile, dispatch_uid="cached_user_profile")
+@receiver(post_delete, sender=Profile, dispatch_uid="cached_user_profile")
+def invalidate_cached_user_profile(sender, instance, **kwargs):
+    users.invalidate(instance.user_id)
+
+
+# cached post cards and profile headers are keyed on updated_at, saving the row itself already bumps it
+def _touch(model, **lookup):
+    model.objects.filter(**lookup).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Photo, dispatch_uid="post_card_photos")
+@receiver(post_delete, sender=Photo, dispatch_uid="post_card_photos")
+def invalidate_photo_card(sender, instance, **kwargs):
+    _touch(Post, pk=instance.post_id)
+
+
+@receiver(post_save, sender=User, dispatch_uid="profile_header_user")
+def invalidate_user_header(sender, instance, created, update_fields=None, **kwargs):
+    if not created and update_fields != frozenset({'last_login'}):
+        _touch(Profile, user=instance)
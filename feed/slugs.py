@@ -0,0 +1,70 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.template.defaultfilters import slugify
+
+from feed.models import Profile, SlugHistory
+
+SLUG_LENGTH = Profile._meta.get_field('slug').max_length
+
+
+def _key(slug):
+    return f'slugs:{slug}'
+
+
+def unique_slug(username, user_id=None):
+    """
+    The username slugified, suffixed with -2, -3... when another user holds it or held it before
+    """
+    base = slugify(username)[:SLUG_LENGTH - 4] or 'user'
+    taken = set(Profile.objects.filter(slug__startswith=base).exclude(user_id=user_id)
+                .values_list('slug', flat=True))
+    taken |= set(SlugHistory.objects.filter(slug__startswith=base).exclude(user_id=user_id)
+                 .values_list('slug', flat=True))
+    slug, suffix = base, 1
+    while slug in taken:
+        suffix += 1
+        slug = f'{base}-{suffix}'
+    return slug
+
+
+def rename(user):
+    """
+    Move a renamed user to the slug of the new username, the old slug goes to the history and keeps redirecting
+    """
+    profile = Profile.objects.filter(user=user).only('slug').first()
+    if profile is None:
+        return
+    slug = unique_slug(user.username, user.id)
+    if slug == profile.slug:
+        return
+    with transaction.atomic():
+        # renamed back to a former username
+        SlugHistory.objects.filter(user=user, slug=slug).delete()
+        if profile.slug:
+            SlugHistory.objects.create(user=user, slug=profile.slug)
+        Profile.objects.filter(pk=profile.pk).update(slug=slug)
+
+
+def lookup(slug, queryset=None):
+    """
+    The profile of a current or former slug, None for an unknown one. The slug -> user id map is cached
+    with a SHARED_CACHE, so a hit costs one lookup by the unique user_id, and a miss on a current slug
+    one by the unique slug.
+    A slug only changes owner once its user is deleted, a cached id without a profile is looked up again
+    """
+    queryset = Profile.objects.all() if queryset is None else queryset
+    user_id = cache.get(_key(slug)) if settings.SHARED_CACHE else None
+    if user_id is not None:
+        profile = queryset.filter(user_id=user_id).first()
+        if profile is not None:
+            return profile
+    profile = queryset.filter(slug=slug).first()
+    if profile is None:
+        user_id = SlugHistory.objects.filter(slug=slug).values_list('user_id', flat=True).first()
+        profile = user_id and queryset.filter(user_id=user_id).first()
+        if not profile:
+            return None
+    if settings.SHARED_CACHE:
+        cache.set(_key(slug), profile.user_id, settings.SLUG_CACHE_TIMEOUT)
+    return profile
@@ -0,0 +1,72 @@
+import re
+
+from django.conf import settings
+from django.db import transaction
+
+from feed.models import Mention, Post, PostTag, Tag, User
+from feed.pagination import KeysetPage, decode_cursor, encode_cursor, key_fields, keyset_filter
+
+HASHTAG = re.compile(r'(?<![\w&])#(\w{1,50})')
+MENTION = re.compile(r'(?<![\w@])@(\w{1,25})')
+
+
+def extract(text):
+    """
+    Normalized hashtags and mentioned usernames of a text
+    """
+    return {tag.lower() for tag in HASHTAG.findall(text)}, set(MENTION.findall(text))
+
+
+def index_posts(posts):
+    """
+    Rewrite the tag and mention rows of the posts, `posts` are (id, text, pub_date) tuples
+    """
+    posts = list(posts)
+    extracted = {post_id: extract(text) for post_id, text, _ in posts}
+    names = set().union(*(tags for tags, _ in extracted.values()))
+    usernames = set().union(*(mentioned for _, mentioned in extracted.values()))
+
+    with transaction.atomic():
+        Tag.objects.bulk_create([Tag(name=name) for name in names], ignore_conflicts=True)
+        tag_ids = dict(Tag.objects.filter(name__in=names).values_list('name', 'id'))
+        user_ids = dict(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+
+        post_ids = [post_id for post_id, _, _ in posts]
+        PostTag.objects.filter(post_id__in=post_ids).delete()
+        Mention.objects.filter(post_id__in=post_ids).delete()
+        PostTag.objects.bulk_create(
+            PostTag(tag_id=tag_ids[name], post_id=post_id, pub_date=pub_date)
+            for post_id, _, pub_date in posts for name in extracted[post_id][0])
+        Mention.objects.bulk_create(
+            Mention(user_id=user_ids[username], post_id=post_id, pub_date=pub_date)
+            for post_id, _, pub_date in posts for username in extracted[post_id][1] if username in user_ids)
+
+
+def index_post(post):
+    index_posts([(post.id, post.text, post.pub_date)])
+
+
+def _page(entries, viewer, cursor):
+    """
+    A page of posts through an inverted index table ordered by (pub_date, post_id)
+    """
+    per_page = settings.FEED_PAGE_SIZE
+    keys = ('-pub_date', '-post_id')
+    if cursor:
+        entries = entries.filter(keyset_filter(keys, decode_cursor(cursor, key_fields(entries, keys))))
+    rows = list(entries.order_by(*keys).values_list('pub_date', 'post_id')[:per_page + 1])
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1])
+    posts = (Post.objects.for_feed(viewer).filter(id__in=[post_id for _, post_id in rows])
+             .order_by('-pub_date', '-id'))
+    return KeysetPage(list(posts), next_cursor)
+
+
+def tag_posts(tag, viewer, cursor=None):
+    return _page(PostTag.objects.filter(tag=tag), viewer, cursor)
+
+
+def mentions(user, viewer, cursor=None):
+    return _page(Mention.objects.filter(user=user), viewer, cursor)
@@ -1,26 +1,90 @@
-from feed.models import User
+from feed import counters, exports, images, mail, notifications, ranking, recommendations, timeline
+from feed.models import AccountExport, User, Photo, Post, Profile
 from celery import shared_task
-from django.contrib.auth.forms import PasswordResetForm
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils import timezone
 
 
 @shared_task
 def send_reset_email_async(subject_template_name, email_template_name, context,
                            from_email, to_email, html_email_template_name):
+    # messages queued before the outbound mail queue, see feed.mail
     context['user'] = User.objects.get(pk=context['user'])
-
-    PasswordResetForm.send_mail(
-        None,
-        subject_template_name,
-        email_template_name,
-        context,
-        from_email,
-        to_email,
-        html_email_template_name
-    )
+    subject = ''.join(render_to_string(subject_template_name, context).splitlines())
+    html_body = render_to_string(html_email_template_name, context) if html_email_template_name else ''
+    mail.enqueue(to_email, subject, render_to_string(email_template_name, context), html_body, from_email)
 
 
 @shared_task
 def send_register_email_async(user_id, subject, message, from_email):
-    user = User.objects.get(pk=user_id)
-    user.email_user(subject, message, from_email)
+    # messages queued before the outbound mail queue, see feed.mail
+    mail.enqueue(User.objects.get(pk=user_id).email, subject, message, from_email=from_email)
+
+
+@shared_task
+def flush_outbound_email():
+    return mail.flush()
+
+
+@shared_task
+def process_photo_variants(photo_id):
+    photo = Photo.objects.filter(pk=photo_id).first()
+    if photo is None:
+        return
+    photo.variants = images.generate_variants(photo.photo, settings.PHOTO_VARIANTS)
+    photo.save(update_fields=['variants'])
+
+
+@shared_task
+def process_avatar_variants(profile_id):
+    profile = Profile.objects.filter(pk=profile_id).first()
+    if profile is None or profile.avatar.name == Profile._meta.get_field('avatar').default:
+        return
+    profile.avatar_variants = images.generate_variants(profile.avatar, settings.AVATAR_VARIANTS)
+    profile.save(update_fields=['avatar_variants', 'updated_at'])
+
+
+@shared_task
+def flush_like_deltas():
+    return counters.flush_likes()
+
+
+@shared_task
+def aggregate_notifications():
+    return notifications.aggregate()
+
+
+@shared_task
+def refresh_suggestions():
+    return recommendations.refresh_all()
+
+
+@shared_task
+def fan_out_post(post_id):
+    post = Post.objects.select_related('user').filter(pk=post_id).first()
+    if post is not None:
+        timeline.fan_out_post(post)
+
+
+@shared_task
+def rescore_posts():
+    return ranking.rescore()
+
+
+@shared_task
+def export_account(export_id, download_url):
+    export = AccountExport.objects.select_related('user').get(pk=export_id)
+    AccountExport.objects.filter(pk=export_id).update(status=AccountExport.RUNNING)
+    try:
+        exports.build_archive(export)
+    except Exception:
+        AccountExport.objects.filter(pk=export_id).update(status=AccountExport.FAILED, finished_at=timezone.now())
+        raise
+    export.status = AccountExport.DONE
+    export.finished_at = timezone.now()
+    export.save(update_fields=['archive', 'status', 'finished_at'])
 
+    context = {'user': export.user, 'download_url': download_url}
+    subject = ''.join(render_to_string('feed/exports/export_ready_email_subject.txt', context).splitlines())
+    mail.enqueue(export.user.email, subject, render_to_string('feed/exports/export_ready_email_body.txt', context))
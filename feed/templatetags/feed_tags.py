@@ -0,0 +1,42 @@
+from django import template
+from django.urls import reverse
+from django.utils.html import conditional_escape, format_html
+from django.utils.safestring import mark_safe
+
+from feed.models import Profile
+from feed.tags import HASHTAG, MENTION
+
+register = template.Library()
+
+
+def _mentioned_slugs(text):
+    """
+    username -> profile slug of the users mentioned in the text, @words that are nobody's username are left out
+    """
+    usernames = set(MENTION.findall(text))
+    if not usernames:
+        return {}
+    return dict(Profile.objects.filter(user__username__in=usernames).exclude(slug='')
+                .values_list('user__username', 'slug'))
+
+
+def _link_mention(match, slugs):
+    slug = slugs.get(match[1])
+    if slug is None:
+        return match[0]
+    return format_html('<a class="text-decoration-none" href="{}">@{}</a>', reverse('feed:profile', args=(slug,)),
+                       match[1])
+
+
+@register.filter(needs_autoescape=True)
+def link_tags(text, autoescape=True):
+    """
+    Post text with #hashtags linked to the tag pages and @mentions of existing users to their profiles
+    """
+    escape = conditional_escape if autoescape else (lambda value: value)
+    slugs = _mentioned_slugs(text)
+    text = escape(text)
+    text = HASHTAG.sub(lambda match: format_html('<a class="text-decoration-none" href="{}">#{}</a>',
+                                                 reverse('feed:tag', args=(match[1].lower(),)), match[1]), text)
+    text = MENTION.sub(lambda match: _link_mention(match, slugs), text)
+    return mark_safe(text)
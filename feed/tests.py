@@ -1,23 +1,60 @@
 import datetime
-from django.db.models import signals
+import json
+import os
+import zipfile
+from io import BytesIO, StringIO
+from unittest import mock
+
+from django.core import mail
+from django.core.mail import get_connection
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed, ValidationError
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import F, signals
+from django.contrib.auth.models import AnonymousUser
+from django.http import Http404, HttpResponse
 from django.urls import reverse
-from django.test import TestCase, Client
+from django.test import AsyncRequestFactory, TestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from django.core.files.uploadedfile import SimpleUploadedFile
+from PIL import Image
+from asgiref.sync import sync_to_async
 
-from .models import Post, User, Profile, Photo, Follower, Like
+from djangogramm_15.celery import app as celery_app
+from . import mail as outbound
+from . import (async_views, benchmark, checks, counters, events, graph, notifications, recommendations, services, slugs,
+               tags, timeline, uploads)
+from .middleware import InstrumentationMiddleware, registry
+from .pagination import encode_cursor
+from .models import (AccountExport, ConfirmedUpload, OutboundEmail, Post, User, Profile, Photo, Follower, Like,
+                     LikeDelta, Mention, Notification, NotificationEvent, PostTag, SlugHistory, Suggestion, TimelineEntry)
+from .tasks import (aggregate_notifications, flush_like_deltas, refresh_suggestions, rescore_posts,
+                    process_photo_variants, process_avatar_variants)
+from .templatetags.feed_tags import link_tags
 
 
+# a single test process, its locmem cache is as good as a shared one. Tasks queued on commit
+# (fan-out, mail, exports) run in-process without a broker
+@override_settings(SHARED_CACHE=True, SESSION_ENGINE='django.contrib.sessions.backends.cached_db',
+                   CELERY_TASK_ALWAYS_EAGER=True, CELERY_BROKER_URL='memory://')
 class GlobalSetUpTestCase(TestCase):
 
     def setUp(self):
+        # the celery app has read its configuration already and takes the broker from the environment first
+        self.enterContext(mock.patch.dict(os.environ, CELERY_BROKER_URL='memory://'))
+        self.addCleanup(setattr, celery_app.conf, 'task_always_eager', celery_app.conf.task_always_eager)
+        celery_app.conf.task_always_eager = True
         signals.post_save.disconnect(sender=User, dispatch_uid="test_data")
+        cache.clear()
         self.client = Client()
         self.user = User.objects.create_user(username='alice', email='qurii@ukr,net', password='qqq')
         self.user_2 = User.objects.create(username='amanda', email='quqqrii@ukr,net', password='qqq')
         self.profile = Profile.objects.create(user=self.user, full_name='Alice Pat', bio='Sunny!')
         self.profile_2 = Profile.objects.create(user=self.user_2, full_name='Amanda Cat', bio='Cloudy!')
-        self.post = Post.objects.create(user=self.user, text='Qwerty...', pub_date=timezone.now())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post = Post.objects.create(user=self.user, text='Qwerty...', pub_date=timezone.now())
         self.photo = Photo.objects.create(post=self.post, user=self.user, photo=SimpleUploadedFile(
             name='test_image.jpg', content=b"some content"))
         self.follower = Follower.objects.create(follower=self.user, following=self.user_2)
@@ -148,3 +185,849 @@ class LikeViewTest(GlobalSetUpTestCase):
             'post_id': self.post.id,
         })
         self.assertTrue(Like.objects.filter(user=self.user, post=self.post.id).exists())
+
+    def test_like_is_idempotent(self):
+        # the fixture like was never counted
+        Post.objects.filter(pk=self.post.pk).update(like_count=1)
+        for _ in range(2):
+            response = self.client.post(reverse('feed:like'), {'post_id': self.post.id, 'action': 'like'})
+            self.assertEqual(response.json(), {'liked': True, 'like_count': 2})
+        for _ in range(2):
+            response = self.client.post(reverse('feed:like'), {'post_id': self.post.id, 'action': 'unlike'})
+            self.assertEqual(response.json(), {'liked': False, 'like_count': 1})
+
+    def test_like_missing_post(self):
+        response = self.client.post(reverse('feed:like'), {'post_id': self.post.id + 100, 'action': 'like'})
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Like.objects.filter(user=self.user).exists())
+        response = self.client.post(reverse('feed:like'), {'post_id': self.post.id, 'action': 'toggle'})
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(LIKE_BUFFER_WRITES=True)
+    def test_buffered_likes(self):
+        response = self.client.post(reverse('feed:like'), {'post_id': self.post.id, 'action': 'like'})
+        self.assertEqual(response.json()['like_count'], 1)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_count, 0)
+        self.assertEqual(flush_like_deltas(), 1)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_count, 1)
+        self.assertFalse(LikeDelta.objects.exists())
+
+
+class TimelineTest(GlobalSetUpTestCase):
+
+    def test_post_fan_out(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            post = Post.objects.create(user=self.user_2, text='Fan out')
+            # fanned out by a task once the post is committed
+            self.assertFalse(TimelineEntry.objects.filter(post=post).exists())
+        self.assertTrue(TimelineEntry.objects.filter(user=self.user, post=post).exists())
+        response = self.client.get(reverse('feed:index'))
+        self.assertContains(response, 'Fan out')
+
+    def test_follow_backfill_and_unfollow_purge(self):
+        post = Post.objects.create(user=self.user_2, text='Backfill')
+        self.follower.delete()
+        self.assertFalse(TimelineEntry.objects.filter(user=self.user).exists())
+        Follower.objects.create(follower=self.user, following=self.user_2)
+        self.assertTrue(TimelineEntry.objects.filter(user=self.user, post=post).exists())
+
+    @override_settings(TIMELINE_CELEBRITY_FOLLOWERS=1)
+    def test_celebrity_merged_on_read(self):
+        Profile.objects.filter(user=self.user_2).update(followers_count=1)
+        post = Post.objects.create(user=self.user_2, text='Celebrity post')
+        self.assertFalse(TimelineEntry.objects.filter(post=post).exists())
+        self.assertIn(post, timeline.get_timeline(self.user))
+
+    @override_settings(TIMELINE_CELEBRITY_FOLLOWERS=1, FEED_PAGE_SIZE=2)
+    def test_post_in_timeline_and_celebrity_merge_once(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            posts = [Post.objects.create(user=self.user_2, text=f'Post {number}') for number in range(3)]
+        # fanned out before the author became a celebrity, with a score that has changed since
+        TimelineEntry.objects.filter(user=self.user, post=posts[2]).update(score=F('score') + 1)
+        Profile.objects.filter(user=self.user_2).update(followers_count=1)
+        self.assertEqual(list(timeline.get_timeline(self.user, ranked=True)), [posts[2], posts[1]])
+
+
+class GraphTest(GlobalSetUpTestCase):
+
+    def test_sets_and_invalidation(self):
+        Follower.objects.create(follower=self.user, following=self.user)
+        self.assertEqual(graph.followings(self.user.id), {self.user_2.id})
+        self.assertTrue(graph.is_following(self.user.id, self.user_2.id))
+        self.assertEqual(graph.mutual(self.user.id), set())
+        Follower.objects.create(follower=self.user_2, following=self.user)
+        self.assertEqual(graph.mutual(self.user.id), {self.user_2.id})
+        Follower.objects.filter(follower=self.user, following=self.user_2).delete()
+        self.assertFalse(graph.is_following(self.user.id, self.user_2.id))
+
+    def test_followed_by_followings(self):
+        user_3 = User.objects.create(username='anna', email='anna@example.com')
+        Profile.objects.create(user=user_3)
+        Follower.objects.create(follower=self.user_2, following=user_3)
+        known = graph.known_followers(user_3.id, graph.followings(self.user.id))
+        self.assertEqual(list(known.values_list('follower_id', flat=True)), [self.user_2.id])
+        response = self.client.get(reverse('feed:profile', args=(user_3.profile.slug,)))
+        self.assertContains(response, 'Followed by')
+
+    def test_profile_page_known_followers_from_viewer_side(self):
+        url = reverse('feed:profile', args=(self.profile_2.slug,))
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertContains(response, 'Unfollow')
+        # the count of known followers (their names only when there are any), never the profile's follower set
+        follower_queries = [query['sql'] for query in queries if Follower._meta.db_table in query['sql']]
+        self.assertEqual(len(follower_queries), 1)
+        self.assertTrue(all('"following_id" = ' in sql for sql in follower_queries))
+
+
+class RankedFeedTest(GlobalSetUpTestCase):
+
+    def test_liked_post_ranks_first(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            older = Post.objects.create(user=self.user_2, text='Older post')
+            newer = Post.objects.create(user=self.user_2, text='Newer post')
+        Post.objects.filter(pk=older.pk).update(like_count=100)
+        self.assertEqual(rescore_posts(), 1)
+        self.assertEqual(list(timeline.get_timeline(self.user)), [newer, older])
+        self.assertEqual(list(timeline.get_timeline(self.user, ranked=True)), [older, newer])
+
+        self.client.post(reverse('feed:feed_mode'), {'feed_mode': Profile.RANKED})
+        response = self.client.get(reverse('feed:index'))
+        self.assertEqual(list(response.context['posts_data']), [older, newer])
+
+    @override_settings(TIMELINE_BATCH_SIZE=1)
+    def test_rescore_skips_entries_of_old_posts(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            old = Post.objects.create(user=self.user_2, text='Old post')
+            recent = Post.objects.create(user=self.user_2, text='Recent post')
+        Follower.objects.create(follower=User.objects.create(username='bob'), following=self.user_2)
+        timeline.backfill(User.objects.get(username='bob'), self.user_2)
+        Post.objects.filter(pk=old.pk).update(pub_date=timezone.now() - datetime.timedelta(days=30))
+        scores = dict(TimelineEntry.objects.filter(post=old).values_list('user_id', 'score'))
+        Post.objects.update(like_count=10)
+        self.assertEqual(rescore_posts(), 3)
+        self.assertEqual(dict(TimelineEntry.objects.filter(post=old).values_list('user_id', 'score')), scores)
+        recent.refresh_from_db()
+        self.assertEqual([entry.score - recent.rank_score for entry in TimelineEntry.objects.filter(post=recent)],
+                         [0.0, 0.0])
+        old.refresh_from_db()
+        self.assertEqual(old.ranked_likes, 10)
+
+    @override_settings(FEED_PAGE_SIZE=1)
+    def test_ranked_pages(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            posts = [Post.objects.create(user=self.user_2, text=f'Post {number}') for number in range(2)]
+        page = timeline.get_timeline(self.user, ranked=True)
+        self.assertEqual(list(page), [posts[1]])
+        self.assertEqual(list(timeline.get_timeline(self.user, page.next_cursor, ranked=True)), [posts[0]])
+        with self.assertRaises(Http404):
+            timeline.get_timeline(self.user, page.next_cursor)
+
+
+class SearchTest(GlobalSetUpTestCase):
+
+    def test_search_posts(self):
+        response = self.client.get(reverse('feed:search'), {'q': 'qwerty'})
+        self.assertEqual(list(response.context['results']), [self.post])
+        response = self.client.get(reverse('feed:search'), {'q': 'nothing like it'})
+        self.assertContains(response, 'Nothing found')
+
+    @override_settings(FOLLOWERS_PAGE_SIZE=1)
+    def test_search_people(self):
+        response = self.client.get(reverse('feed:search'), {'q': 'a', 'type': 'people'})
+        self.assertEqual(len(response.context['results']), 1)
+        response = self.client.get(reverse('feed:search') + response.context['next_page_url'])
+        self.assertEqual(len(response.context['results']), 1)
+        self.assertNotIn('next_page_url', response.context)
+        response = self.client.get(reverse('feed:search'), {'q': 'cloudy', 'type': 'people'})
+        self.assertEqual([profile.user for profile in response.context['results']], [self.user_2])
+
+
+class TagsTest(GlobalSetUpTestCase):
+
+    def test_extract(self):
+        self.assertEqual(tags.extract('#Sunny day with @amanda, #sunny! mail a@b.c &#39;'),
+                         ({'sunny'}, {'amanda'}))
+
+    def test_tag_and_mention_pages(self):
+        post = Post.objects.create(user=self.user_2, text='Hello @alice #Sunset')
+        response = self.client.get(reverse('feed:tag', args=('sunset',)))
+        self.assertEqual(list(response.context['posts']), [post])
+        self.assertContains(response, f'href="{reverse("feed:tag", args=("sunset",))}"')
+        response = self.client.get(reverse('feed:mentions'))
+        self.assertEqual(list(response.context['posts']), [post])
+
+        post.text = 'No tags anymore'
+        post.save()
+        self.assertFalse(PostTag.objects.exists())
+        self.assertFalse(Mention.objects.exists())
+
+    def test_link_tags(self):
+        self.user_2.username = 'amanda.cat'
+        self.user_2.save()
+        text = link_tags('hi @_ there, привіт @Андрій and @amanda.cat @alice #Sunset')
+        self.assertIn(f'<a class="text-decoration-none" href="{reverse("feed:profile", args=("alice",))}">@alice</a>',
+                      text)
+        # usernames with characters outside \w are not matched whole, and nobody is called "amanda"
+        self.assertNotIn('/feed/profile/amanda', text)
+        self.assertIn('hi @_ there, привіт @Андрій and', text)
+        self.assertIn(f'href="{reverse("feed:tag", args=("sunset",))}"', text)
+        # the slug of a later user with a taken name is suffixed
+        self.user.username = 'alicia'
+        self.user.save()
+        Profile.objects.create(user=User.objects.create(username='alice', email='new@x.net'))
+        self.assertIn(f'href="{reverse("feed:profile", args=("alice-2",))}"', link_tags('@alice'))
+
+    def test_extract_tags_command(self):
+        Post.objects.bulk_create([Post(user=self.user, text=f'#bulk post {number}') for number in range(5)])
+        call_command('extract_tags', batch_size=2, stdout=StringIO())
+        self.assertEqual(PostTag.objects.filter(tag__name='bulk').count(), 5)
+
+
+class AccountExportTest(GlobalSetUpTestCase):
+
+    def test_export_archive(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('feed:exports'))
+        export = AccountExport.objects.get(user=self.user)
+        self.assertEqual(export.status, AccountExport.DONE)
+        with zipfile.ZipFile(export.archive.open()) as archive:
+            names = archive.namelist()
+            posts = [json.loads(line) for line in archive.read('posts.jsonl').splitlines()]
+            followings = archive.read('followings.jsonl').decode()
+        self.assertIn('profile.json', names)
+        self.assertEqual([post['text'] for post in posts], [self.post.text])
+        self.assertIn('amanda', followings)
+        self.assertTrue(any(name.startswith('photos/') for name in names))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn(reverse('feed:exports'), mail.outbox[0].body)
+        self.assertEqual(self.client.get(reverse('feed:export_download', args=(export.id,))).status_code, 302)
+
+
+class OutboundEmailTest(GlobalSetUpTestCase):
+
+    def setUp(self):
+        super().setUp()
+        outbound._reset_connection()
+
+    def test_batch_over_one_connection(self):
+        with mock.patch('feed.mail.get_connection', wraps=get_connection) as connections:
+            with self.captureOnCommitCallbacks(execute=True):
+                for number in range(3):
+                    outbound.enqueue(f'user{number}@example.com', 'Subject', 'Body')
+            self.assertEqual(connections.call_count, 1)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(OutboundEmail.objects.filter(status=OutboundEmail.SENT).count(), 3)
+        self.assertEqual(outbound.metrics()['sent'], 3)
+
+    def test_retry_with_backoff(self):
+        email = outbound.enqueue('user@example.com', 'Subject', 'Body')
+        with mock.patch('feed.mail._send', side_effect=ConnectionRefusedError('down')):
+            self.assertEqual(outbound.flush(), 0)
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutboundEmail.PENDING, 1))
+        self.assertGreater(email.next_attempt_at, timezone.now())
+        self.assertEqual(outbound.flush(), 0)  # not due yet
+        OutboundEmail.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(outbound.flush(), 1)
+        self.assertEqual(outbound.metrics()['retried'], 1)
+
+    def test_claimed_while_sending(self):
+        email = outbound.enqueue('user@example.com', 'Subject', 'Body')
+        statuses = []
+        with mock.patch('feed.mail._send', side_effect=lambda sending: statuses.append(
+                OutboundEmail.objects.get(pk=sending.pk).status)):
+            self.assertEqual(outbound.flush(), 1)
+        self.assertEqual(statuses, [OutboundEmail.SENDING])
+        # a flush that died after claiming
+        OutboundEmail.objects.filter(pk=email.pk).update(status=OutboundEmail.SENDING, claimed_at=timezone.now())
+        self.assertEqual(outbound.flush(), 0)
+        OutboundEmail.objects.filter(pk=email.pk).update(claimed_at=timezone.now() - datetime.timedelta(hours=1))
+        self.assertEqual(outbound.flush(), 1)
+
+    def test_password_reset_is_queued(self):
+        self.user.email = 'alice@example.com'
+        self.user.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('feed:password_reset'), {'email': 'alice@example.com'})
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['alice@example.com'])
+
+
+class SuggestionTest(GlobalSetUpTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user_3 = User.objects.create(username='anna', email='anna@example.com')
+        Profile.objects.create(user=self.user_3)
+        Follower.objects.create(follower=self.user_2, following=self.user_3)
+
+    def test_friends_of_friends(self):
+        self.assertEqual(refresh_suggestions(), Suggestion.objects.count())
+        suggestion = Suggestion.objects.get(user=self.user)
+        self.assertEqual((suggestion.suggested, suggestion.reason), (self.user_3, Suggestion.FRIENDS))
+        # amanda is already followed, nobody suggests people to themselves
+        self.assertFalse(Suggestion.objects.filter(suggested=F('user')).exists())
+
+    def test_empty_feed_shows_suggestions(self):
+        response = self.client.get(reverse('feed:index'))
+        self.assertEqual(list(response.context['suggested_users']), [self.user_3])
+        recommendations.refresh([self.user.id])
+        Follower.objects.create(follower=self.user, following=self.user_3)
+        response = self.client.get(reverse('feed:index'))
+        self.assertNotContains(response, 'anna')
+
+
+@override_settings(FEED_PAGE_SIZE=2)
+class PaginationTest(GlobalSetUpTestCase):
+
+    def test_feed_pages(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            posts = [Post.objects.create(user=self.user_2, text=f'Page post {number}') for number in range(3)]
+        response = self.client.get(reverse('feed:index'))
+        self.assertEqual(list(response.context['posts_data']), posts[:0:-1])
+        next_page = self.client.get(response.context['next_page_url']).json()
+        self.assertIn('Page post 0', next_page['html'])
+        self.assertNotIn('Page post 2', next_page['html'])
+        self.assertIsNone(next_page['next_page_url'])
+
+    def test_profile_pages(self):
+        Post.objects.create(user=self.user, text='Newest post')
+        response = self.client.get(reverse('feed:profile', args=(self.profile.slug,)))
+        self.assertEqual(len(response.context['posts']), 2)
+        self.assertContains(response, 'Newest post')
+        self.assertIsNone(response.context['next_page_url'])
+        Post.objects.create(user=self.user, text='Even newer post')
+        response = self.client.get(reverse('feed:profile', args=(self.profile.slug,)))
+        self.assertNotContains(response, self.post.text)
+        self.assertIn(self.post.text, self.client.get(response.context['next_page_url']).json()['html'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('feed:posts_page'), {'cursor': 'nonsense'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_crafted_cursors(self):
+        Post.objects.create(user=self.user, text='#sunset')
+        urls = [reverse('feed:posts_page'), reverse('feed:index'), reverse('feed:tag', args=('sunset',))]
+        for values in (['abc', 'x'], [None, None], [{'a': 1}, 1], ['2024-01-01T00:00:00', 'zz']):
+            for url in urls:
+                with self.subTest(values=values, url=url):
+                    response = self.client.get(url, {'cursor': encode_cursor(values)})
+                    self.assertEqual(response.status_code, 404)
+
+
+class FeedQueryTest(GlobalSetUpTestCase):
+
+    def _count_feed_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('feed:index'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_constant_query_count(self):
+        post = Post.objects.create(user=self.user_2, text='First')
+        Photo.objects.create(post=post, user=self.user_2, photo='feed/profiles_photos/1.jpg')
+        self._count_feed_queries()  # caches the navbar's unread count
+        few_posts = self._count_feed_queries()
+        for number in range(5):
+            post = Post.objects.create(user=self.user_2, text=f'Post {number}')
+            Photo.objects.create(post=post, user=self.user_2, photo='feed/profiles_photos/1.jpg')
+            Like.objects.create(user=self.user, post=post)
+        self.assertEqual(self._count_feed_queries(), few_posts)
+
+    def test_like_annotations(self):
+        self.assertTrue(Post.objects.for_feed(self.user_2).get(pk=self.post.pk).is_liked_by_viewer)
+        self.assertFalse(Post.objects.for_feed(self.user).get(pk=self.post.pk).is_liked_by_viewer)
+
+
+class CountersTest(GlobalSetUpTestCase):
+
+    def test_like_counter(self):
+        self.client.post(reverse('feed:like'), {'post_id': self.post.id})
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_count, 1)
+        self.client.post(reverse('feed:like'), {'post_id': self.post.id, 'action': 'unlike'})
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_count, 0)
+
+    def test_follow_counters(self):
+        url = reverse('feed:profile', args=(self.profile_2.slug,))
+        self.client.post(url)  # unfollow, the fixture rows were never counted
+        self.client.post(url)  # follow again
+        self.profile.refresh_from_db()
+        self.profile_2.refresh_from_db()
+        self.assertEqual((self.profile.following_count, self.profile_2.followers_count), (1, 1))
+
+    def test_concurrent_follow_counted_once(self):
+        url = reverse('feed:profile', args=(self.profile_2.slug,))
+        # the other request inserted the row after this one found nothing to delete
+        with mock.patch('django.db.models.query.QuerySet.delete', return_value=(0, {})):
+            response = self.client.post(url)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Follower.objects.filter(follower=self.user, following=self.user_2).count(), 1)
+        self.profile_2.refresh_from_db()
+        self.assertEqual(self.profile_2.followers_count, 0)
+
+    def test_reconcile(self):
+        call_command('reconcile_counters', stdout=StringIO())
+        self.post.refresh_from_db()
+        self.profile.refresh_from_db()
+        self.profile_2.refresh_from_db()
+        self.assertEqual(self.post.like_count, 1)
+        self.assertEqual(self.profile.following_count, 1)
+        self.assertEqual(self.profile_2.followers_count, 1)
+        response = self.client.get(reverse('feed:profile', args=(self.profile_2.slug,)))
+        self.assertContains(response, 'Followers:</a> 1')
+
+
+class FragmentCacheTest(GlobalSetUpTestCase):
+
+    def test_post_card_cached_until_changed(self):
+        url = reverse('feed:post', args=(self.post.id,))
+        self.client.get(url)
+        Post.objects.filter(pk=self.post.pk).update(text='Changed behind the cache')
+        self.assertContains(self.client.get(url), self.post.text)
+        self.post.text = 'Edited post'
+        self.post.save()
+        self.assertContains(self.client.get(url), 'Edited post')
+
+    def test_like_state_not_cached(self):
+        url = reverse('feed:post', args=(self.post.id,))
+        self.assertContains(self.client.get(url), 'bi bi-heart"')
+        Like.objects.create(user=self.user, post=self.post)
+        self.assertContains(self.client.get(url), 'bi bi-heart-fill')
+
+    def test_profile_header_invalidated(self):
+        url = reverse('feed:profile', args=(self.profile.slug,))
+        self.client.get(url)
+        self.profile.bio = 'Rainy!'
+        self.profile.save()
+        self.assertContains(self.client.get(url), 'Rainy!')
+
+
+class ImageVariantsTest(GlobalSetUpTestCase):
+
+    def _jpeg_with_exif(self, size=(2000, 1000)):
+        exif = Image.Exif()
+        exif[0x010F] = 'Camera maker'
+        buffer = BytesIO()
+        Image.new('RGB', size, 'green').save(buffer, 'JPEG', exif=exif)
+        return SimpleUploadedFile(name='exif.jpg', content=buffer.getvalue())
+
+    def test_photo_variants(self):
+        photo = Photo.objects.create(post=self.post, user=self.user, photo=self._jpeg_with_exif())
+        process_photo_variants(photo.id)
+        photo.refresh_from_db()
+        self.assertEqual(photo.variants['feed']['width'], 700)
+        self.assertEqual(photo.variants['thumb']['width'], 150)
+        with photo.photo.storage.open(photo.variants['full']['jpeg']) as file:
+            variant = Image.open(file)
+            self.assertEqual(variant.size, (1400, 700))
+            self.assertFalse(variant.getexif())
+        response = self.client.get(reverse('feed:post', args=(self.post.id,)))
+        self.assertContains(response, 'image/webp')
+        self.assertContains(response, '700w')
+
+    def test_narrow_transparent_photo(self):
+        image = Image.new('P', (500, 300))
+        image.info['transparency'] = 0
+        buffer = BytesIO()
+        image.save(buffer, 'PNG', transparency=0)
+        photo = Photo.objects.create(post=self.post, user=self.user,
+                                     photo=SimpleUploadedFile(name='narrow.png', content=buffer.getvalue()))
+        process_photo_variants(photo.id)
+        photo.refresh_from_db()
+        self.assertEqual(photo.variants['feed'], photo.variants['full'])
+        self.assertEqual(photo.webp_srcset.count('500w'), 1)
+        with photo.photo.storage.open(photo.variants['feed']['webp']) as file:
+            self.assertEqual(Image.open(file).mode, 'RGBA')
+
+    def test_avatar_variants(self):
+        self.profile.avatar = self._jpeg_with_exif((400, 400))
+        self.profile.save()
+        process_avatar_variants(self.profile.id)
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.avatar_variants['thumb']['width'], 150)
+        self.assertIn('_thumb.jpeg', self.profile.avatar_thumb_url)
+
+
+class CreatePostServiceTest(GlobalSetUpTestCase):
+
+    def _png(self, name):
+        buffer = BytesIO()
+        Image.new('RGB', (10, 10), 'red').save(buffer, 'PNG')
+        return SimpleUploadedFile(name=name, content=buffer.getvalue(), content_type='image/png')
+
+    def test_post_with_photos(self):
+        response = self.client.post(reverse('feed:index'), {
+            'text': 'Three photos',
+            'photos-0-photo': [self._png('1.png'), self._png('2.png'), self._png('3.png')],
+        })
+        self.assertRedirects(response, reverse('feed:index'))
+        post = Post.objects.get(text='Three photos')
+        self.assertEqual(post.photos.count(), 3)
+
+    def test_invalid_photo_writes_nothing(self):
+        with self.assertRaises(ValidationError):
+            services.create_post(self.user, 'Broken', [SimpleUploadedFile(name='bad.png', content=b'not an image')])
+        self.assertFalse(Post.objects.filter(text='Broken').exists())
+
+
+class DirectUploadTest(GlobalSetUpTestCase):
+
+    def _upload(self, kind, content=None):
+        ticket = self.client.post(reverse('feed:upload_ticket'), {'kind': kind, 'filename': 'pic.png'}).json()
+        if content is None:
+            buffer = BytesIO()
+            Image.new('RGB', (10, 10), 'blue').save(buffer, 'PNG')
+            content = buffer.getvalue()
+        response = self.client.post(ticket['url'], dict(ticket['fields'], file=SimpleUploadedFile(
+            name='pic.png', content=content, content_type='image/png')))
+        self.assertEqual(response.status_code, 204)
+        return ticket['token']
+
+    def test_post_with_uploaded_photo(self):
+        token = self._upload('photo')
+        response = self.client.post(reverse('feed:index'), {'text': 'Direct', 'upload_token': token})
+        self.assertRedirects(response, reverse('feed:index'))
+        photo = Photo.objects.get(post__text='Direct')
+        self.assertTrue(photo.photo.name.startswith(f'feed/profiles_photos/{self.user.id}/'))
+
+    def test_rejected_post_keeps_token(self):
+        token = self._upload('photo')
+        bad = SimpleUploadedFile(name='bad.png', content=b'not an image', content_type='image/png')
+        response = self.client.post(reverse('feed:index'), {'text': 'Direct', 'upload_token': token, 'photo': bad})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(ConfirmedUpload.objects.exists())
+        response = self.client.post(reverse('feed:index'), {'text': 'Direct', 'upload_token': token})
+        self.assertRedirects(response, reverse('feed:index'))
+
+    def test_confirm_avatar(self):
+        token = self._upload('avatar')
+        response = self.client.post(reverse('feed:confirm_avatar'), {'token': token})
+        self.assertEqual(response.status_code, 200)
+        self.profile.refresh_from_db()
+        self.assertTrue(self.profile.avatar.name.startswith(f'feed/avatars/{self.user.id}/'))
+
+    def test_token_used_once(self):
+        token = self._upload('avatar')
+        self.assertEqual(self.client.post(reverse('feed:confirm_avatar'), {'token': token}).status_code, 200)
+        response = self.client.post(reverse('feed:confirm_avatar'), {'token': token})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(ConfirmedUpload.objects.count(), 1)
+
+    def test_not_an_image_rejected(self):
+        token = self._upload('avatar', content=b'<html>not a png</html>')
+        response = self.client.post(reverse('feed:confirm_avatar'), {'token': token})
+        self.assertEqual(response.status_code, 400)
+        self.profile.refresh_from_db()
+        self.assertFalse(self.profile.avatar.name.startswith('feed/avatars/'))
+
+    def test_foreign_or_missing_upload_rejected(self):
+        ticket = uploads.create_ticket(self.user_2, 'avatar', 'pic.png')
+        response = self.client.post(reverse('feed:confirm_avatar'), {'token': ticket['token']})
+        self.assertEqual(response.status_code, 400)
+        ticket = uploads.create_ticket(self.user, 'avatar', 'pic.png')
+        response = self.client.post(reverse('feed:confirm_avatar'), {'token': ticket['token']})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(INSTRUMENTATION_SAMPLE_RATE=1, INSTRUMENTATION_DUPLICATE_THRESHOLD=1)
+class InstrumentationTest(GlobalSetUpTestCase):
+
+    def setUp(self):
+        super().setUp()
+        registry.clear()
+
+    def test_records_sampled_requests(self):
+        with self.assertLogs('feed.instrumentation') as logs:
+            self.client.get(reverse('feed:index'))
+        self.assertTrue(any('ran the same query' in line for line in logs.output))
+        stats = registry.views['feed:index']
+        self.assertEqual(stats['requests'], 1)
+        self.assertGreater(stats['queries'], 0)
+        self.assertGreater(stats['template_seconds'], 0)
+
+    def test_metrics_endpoint(self):
+        with self.assertLogs('feed.instrumentation'):
+            self.client.get(reverse('feed:index'))
+            self.assertEqual(self.client.get(reverse('feed:metrics')).status_code, 403)
+            self.user.is_staff = True
+            self.user.save()
+            response = self.client.get(reverse('feed:metrics'))
+            self.assertContains(response, 'djangogramm_request_seconds_count{view="feed:index"} 1')
+            with override_settings(METRICS_TOKEN='secret'):
+                response = Client().get(reverse('feed:metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(INSTRUMENTATION_SAMPLE_RATE=0)
+    def test_not_used_without_sampling(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            InstrumentationMiddleware(lambda request: HttpResponse())
+
+
+class AsyncViewsTest(GlobalSetUpTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.factory = AsyncRequestFactory()
+
+    def _request(self, method, path, data=None, user=None):
+        request = getattr(self.factory, method)(path, data or {})
+        request.user = user or self.user
+        return request
+
+    async def test_index_profile_and_post(self):
+        response = await async_views.index(self._request('get', reverse('feed:index')))
+        self.assertEqual(response.status_code, 200)
+        response = await async_views.profile_detail(
+            self._request('get', reverse('feed:profile', args=(self.profile_2.slug,))), slug=self.profile_2.slug)
+        self.assertContains(response, self.profile_2.bio)
+        self.assertContains(response, 'Unfollow')
+        self.assertNotContains(response, 'Follows you')
+        response = await async_views.post_detail(
+            self._request('get', reverse('feed:post', args=(self.post.id,))), pk=self.post.id)
+        self.assertContains(response, self.post.text)
+
+    @override_settings(TIMELINE_CELEBRITY_FOLLOWERS=1)
+    async def test_timeline_matches_sync(self):
+        await sync_to_async(Post.objects.create)(user=self.user_2, text='Fanned out')
+        await Profile.objects.filter(user=self.user_2).aupdate(followers_count=1)
+        await sync_to_async(Post.objects.create)(user=self.user_2, text='Celebrity post')
+        for ranked in (False, True):
+            expected = await sync_to_async(timeline.get_timeline)(self.user, ranked=ranked)
+            page = await timeline.aget_timeline(self.user, ranked=ranked)
+            self.assertEqual(len(page), 2)
+            self.assertEqual(list(page), list(expected))
+
+    async def test_like(self):
+        request = self._request('post', reverse('feed:like'), {'post_id': self.post.id})
+        response = await async_views.like(request)
+        self.assertEqual(json.loads(response.content), {'liked': True, 'like_count': 1})
+        response = await async_views.like(self._request('get', reverse('feed:like')))
+        self.assertEqual(response.status_code, 405)
+        response = await async_views.like(self._request('post', reverse('feed:like'), {'post_id': 'x'}))
+        self.assertEqual(response.status_code, 400)
+        with self.assertRaises(Http404):
+            await async_views.like(self._request('post', reverse('feed:like'), {'post_id': 0}))
+
+    async def test_login_required(self):
+        response = await async_views.index(self._request('get', reverse('feed:index'), user=AnonymousUser()))
+        self.assertEqual(response.status_code, 302)
+
+    @override_settings(INSTRUMENTATION_SAMPLE_RATE=1)
+    async def test_instrumentation(self):
+        async def view(request):
+            return HttpResponse(await Post.objects.acount())
+
+        registry.clear()
+        with self.assertLogs('feed.instrumentation'):
+            await InstrumentationMiddleware(view)(self._request('get', '/'))
+        self.assertEqual(registry.views['unresolved']['queries'], 1)
+
+
+class PushEventsTest(GlobalSetUpTestCase):
+
+    async def test_broker_delivers_across_threads(self):
+        subscription = events.broker.subscribe([events.author_channel(1)])
+        delivered = await sync_to_async(events.broker.publish, thread_sensitive=False)(
+            events.author_channel(1), {'type': 'post', 'post_id': 1, 'author_id': 1})
+        self.assertEqual(delivered, 1)
+        self.assertEqual(await subscription.get(1), [{'type': 'post', 'post_id': 1, 'author_id': 1}])
+        events.broker.unsubscribe(subscription)
+        self.assertEqual(events.broker.publish(events.author_channel(1), {'type': 'post'}), 0)
+
+    def test_like_and_post_published_on_commit(self):
+        with mock.patch.object(events.broker, 'publish') as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse('feed:like'), {'post_id': self.post.id, 'action': 'like'})
+                self.client.post(reverse('feed:like'), {'post_id': self.post.id, 'action': 'like'})
+                post = Post.objects.create(user=self.user_2, text='Pushed')
+        self.assertEqual(publish.call_args_list, [
+            mock.call(events.author_channel(self.user.id), {'type': 'like', 'post_id': self.post.id, 'like_count': 1}),
+            mock.call(events.author_channel(self.user_2.id), {'type': 'post', 'post_id': post.id,
+                                                                'author_id': self.user_2.id}),
+        ])
+
+    @override_settings(PUSH_EVENTS_HEARTBEAT=0.01)
+    async def test_stream(self):
+        request = AsyncRequestFactory().get('/feed/events/')
+        request.user = self.user
+        response = await async_views.push_events(request)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertTrue(response.is_async)
+
+        content = events.stream(self.user.id, [events.author_channel(self.user.id),
+                                               events.author_channel(self.user_2.id)])
+        self.assertEqual(await anext(content), 'retry: 5000\n\n')
+        self.assertEqual(await anext(content), ': keep-alive\n\n')
+        for like_count in (1, 2):
+            events.broker.publish(events.author_channel(self.user_2.id),
+                                  {'type': 'like', 'post_id': 7, 'like_count': like_count})
+        # own new posts are left out
+        events.broker.publish(events.author_channel(self.user.id), {'type': 'post', 'post_id': 8,
+                                                                     'author_id': self.user.id})
+        self.assertEqual(await anext(content),
+                         'event: like\ndata: {"type": "like", "post_id": 7, "like_count": 2}\n\n')
+        await content.aclose()
+        self.assertEqual(events.broker.publish(events.author_channel(self.user_2.id), {'type': 'post'}), 0)
+
+
+class NotificationsTest(GlobalSetUpTestCase):
+
+    def test_likes_aggregated_into_one_notification(self):
+        for number in range(3):
+            fan = User.objects.create(username=f'fan{number}', email=f'fan{number}@example.com')
+            Profile.objects.create(user=fan)
+            counters.set_like(fan.id, self.post.id, True)
+        Follower.objects.create(follower=self.user_2, following=self.user)
+        counters.set_like(self.user.id, self.post.id, True)  # own likes don't notify
+        # and the fixture's follow of amanda
+        self.assertEqual(NotificationEvent.objects.count(), 5)
+
+        self.assertEqual(aggregate_notifications(), 5)
+        self.assertFalse(NotificationEvent.objects.exists())
+        like = Notification.objects.get(recipient=self.user, kind=NotificationEvent.LIKE)
+        self.assertEqual((like.actor_count, like.last_actor.username, like.post_id), (3, 'fan2', self.post.id))
+        self.assertEqual(notifications.unread_count(self.user.id), 2)
+        with self.assertNumQueries(0):
+            notifications.unread_count(self.user.id)
+        # an actor is counted once per notification
+        fan = User.objects.get(username='fan0')
+        counters.set_like(fan.id, self.post.id, False)
+        counters.set_like(fan.id, self.post.id, True)
+        self.assertEqual(aggregate_notifications(), 1)
+        like.refresh_from_db()
+        self.assertEqual((like.actor_count, like.last_actor.username), (3, 'fan2'))
+        response = self.client.get(reverse('feed:notifications'))
+        self.assertContains(response, 'fan2</a>')
+        self.assertContains(response, 'and 2 others')
+        self.assertContains(response, 'amanda</a>')
+        self.assertContains(response, 'followed you')
+
+        self.client.post(reverse('feed:notifications'))
+        self.assertEqual(notifications.unread_count(self.user.id), 0)
+        # a like after the group was read opens a new one
+        counters.set_like(self.user_2.id, self.post.id, False)
+        counters.set_like(self.user_2.id, self.post.id, True)
+        aggregate_notifications()
+        self.assertEqual(notifications.unread_count(self.user.id), 1)
+        self.assertEqual(Notification.objects.filter(recipient=self.user).count(), 3)
+
+    def test_aggregation_skipped_while_locked(self):
+        self.assertEqual(NotificationEvent.objects.count(), 1)
+        # another worker is folding a batch
+        with mock.patch('feed.notifications._try_lock', return_value=False):
+            self.assertEqual(aggregate_notifications(), 0)
+        self.assertEqual(NotificationEvent.objects.count(), 1)
+        self.assertEqual(aggregate_notifications(), 1)
+
+
+class CachedUserTest(GlobalSetUpTestCase):
+
+    def _queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [query['sql'] for query in queries]
+
+    def test_session_user_and_profile_from_cache(self):
+        url = reverse('feed:mentions')
+        first = self._queries(url)
+        second = self._queries(url)
+        self.assertLessEqual(len(second), len(first) - 3)
+        self.assertFalse([sql for sql in second if 'django_session' in sql or 'FROM "feed_user" WHERE' in sql
+                          or 'FROM "feed_profile" WHERE "feed_profile"."user_id"' in sql])
+
+    def test_invalidated_on_save(self):
+        self.client.get(reverse('feed:mentions'))
+        self.profile.slug = 'alice-renamed'
+        self.profile.save()
+        self.assertContains(self.client.get(reverse('feed:mentions')), 'alice-renamed')
+        self.client.post(reverse('feed:feed_mode'), {'feed_mode': Profile.RANKED})
+        self.assertEqual(self.client.get(reverse('feed:index')).context['feed_mode'], Profile.RANKED)
+        # a new password ends the other sessions, the cached user included
+        self.user.set_password('new password')
+        self.user.save()
+        self.assertRedirects(self.client.get(reverse('feed:mentions')),
+                             f"{reverse('feed:login')}?next={reverse('feed:mentions')}")
+
+
+    @override_settings(SHARED_CACHE=False, SESSION_ENGINE='django.contrib.sessions.backends.db')
+    def test_process_local_cache_bypassed(self):
+        url = reverse('feed:mentions')
+        self._queries(url)
+        queries = self._queries(url)
+        self.assertTrue([sql for sql in queries if 'django_session' in sql])
+        self.assertTrue([sql for sql in queries if 'FROM "feed_user" WHERE' in sql])
+        self.assertEqual(checks.shared_cache(None)[0].id, 'feed.W001')
+
+
+class SlugTest(GlobalSetUpTestCase):
+
+    def test_unique_slugs(self):
+        self.assertEqual(self.profile.slug, 'alice')
+        for username in ('alice!', 'alice.'):
+            Profile.objects.create(user=User.objects.create(username=username, email=f'{username}@x.net'))
+        self.assertEqual(set(Profile.objects.filter(slug__startswith='alice').values_list('slug', flat=True)),
+                         {'alice', 'alice-2', 'alice-3'})
+
+    def test_renamed_user_redirects(self):
+        self.user.username = 'alicia'
+        self.user.save()
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.slug, 'alicia')
+        self.assertRedirects(self.client.get(reverse('feed:followers', args=['alice'])),
+                             reverse('feed:followers', args=['alicia']), status_code=301)
+        self.assertEqual(self.client.get(reverse('feed:profile', args=['alicia'])).status_code, 200)
+        # the former slug is not handed out again
+        newcomer = User.objects.create(username='alice', email='new@x.net')
+        self.assertEqual(Profile.objects.create(user=newcomer).slug, 'alice-2')
+        # renamed back, the slug comes out of the history
+        self.user.username = 'alice.'
+        self.user.save(update_fields=['username'])
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.slug, 'alice')
+        self.assertEqual(set(SlugHistory.objects.filter(user=self.user).values_list('slug', flat=True)), {'alicia'})
+
+    def test_cached_lookup(self):
+        self.assertIsNone(slugs.lookup('nobody'))
+        self.assertEqual(self.client.get(reverse('feed:profile', args=['nobody'])).status_code, 404)
+        self.assertEqual(slugs.lookup('alice'), self.profile)
+        with self.assertNumQueries(1):
+            self.assertEqual(slugs.lookup('alice'), self.profile)
+
+
+class SeedDataTest(TestCase):
+
+    def test_seed_data(self):
+        call_command('seed_data', users=30, posts=120, follows=5, likes=4, placeholders=2, seed=1,
+                     stdout=StringIO())
+        self.assertEqual(User.objects.filter(username__startswith='seed').count(), 30)
+        self.assertEqual(Profile.objects.filter(user__username__startswith='seed').count(), 30)
+        self.assertEqual(Post.objects.count(), 120)
+        self.assertTrue(Photo.objects.filter(photo__startswith='feed/placeholders/').exists())
+        post = Post.objects.order_by('-like_count').first()
+        self.assertEqual(post.like_count, post.likes.count())
+        self.assertGreater(Post.objects.values('pub_date').distinct().count(), 100)
+        self.assertTrue(TimelineEntry.objects.exists())
+
+
+class BenchmarkTest(TestCase):
+
+    def test_run_and_compare(self):
+        call_command('seed_data', users=10, posts=30, follows=3, likes=2, placeholders=1, seed=2, stdout=StringIO())
+        results = benchmark.run(requests=2)
+        self.assertEqual(set(results['endpoints']),
+                         {'index', 'profile', 'post', 'followers', 'like', 'registration'})
+        self.assertGreater(results['endpoints']['index']['bytes_mean'], 0)
+
+        rows, regressed = benchmark.compare(results, results)
+        self.assertFalse(regressed)
+        slower = json.loads(json.dumps(results))
+        slower['endpoints']['index']['queries_max'] += 1
+        rows, regressed = benchmark.compare(results, slower)
+        self.assertTrue(regressed)
@@ -0,0 +1,155 @@
+import asyncio
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Case, F, FloatField, Value, When
+from django.db.models.functions import Coalesce
+
+from feed import ranking
+from feed.models import Follower, Post, Profile, TimelineEntry
+from feed.pagination import KeysetPage, alist, decode_cursor, encode_cursor, keyset_filter
+
+
+def is_celebrity(user):
+    """
+    Celebrities have too many followers to fan out to, their posts are merged in on read
+    """
+    return Profile.objects.filter(user=user, followers_count__gte=settings.TIMELINE_CELEBRITY_FOLLOWERS).exists()
+
+
+def _followed_celebrities(user):
+    return Follower.objects.filter(
+        follower=user, following__profile__followers_count__gte=settings.TIMELINE_CELEBRITY_FOLLOWERS,
+    ).values_list('following_id', flat=True)
+
+
+def followed_celebrities(user):
+    return list(_followed_celebrities(user))
+
+
+def _bulk_insert(entries):
+    entries = iter(entries)
+    while batch := list(islice(entries, settings.TIMELINE_BATCH_SIZE)):
+        TimelineEntry.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def fan_out_post(post):
+    """
+    Push a new post into the timelines of everybody who follows its author, run by the
+    fan_out_post task once the post is committed
+    """
+    score = ranking.rank_post(post)
+    if is_celebrity(post.user):
+        return
+    follower_ids = Follower.objects.filter(following=post.user).values_list('follower_id', flat=True).iterator()
+    while batch := list(islice(follower_ids, settings.TIMELINE_BATCH_SIZE)):
+        affinities = ranking.affinities(post.user_id, batch)
+        _bulk_insert(TimelineEntry(user_id=follower_id, post=post, pub_date=post.pub_date,
+                                   score=score + affinities[follower_id])
+                     for follower_id in batch)
+
+
+def backfill(follower, following):
+    """
+    Copy the latest posts of a freshly followed user into the follower's timeline
+    """
+    if is_celebrity(following):
+        return
+    posts = (Post.objects.filter(user=following)
+             .values_list('id', 'pub_date', 'rank_score')[:settings.TIMELINE_BACKFILL_SIZE])
+    affinity = ranking.affinities(following.id, [follower.id])[follower.id]
+    _bulk_insert(TimelineEntry(user=follower, post_id=post_id, pub_date=pub_date, score=(score or 0) + affinity)
+                 for post_id, pub_date, score in posts)
+
+
+def purge(follower, following):
+    """
+    Drop the posts of an unfollowed user from the follower's timeline
+    """
+    TimelineEntry.objects.filter(user=follower, post__user=following).delete()
+
+
+def rebuild(user):
+    TimelineEntry.objects.filter(user=user).delete()
+    for following in Follower.objects.filter(follower=user).select_related('following'):
+        backfill(user, following.following)
+
+
+def _after(cursor, key):
+    if not cursor:
+        return None
+    # a cursor of the other feed mode doesn't convert either
+    return decode_cursor(cursor, [TimelineEntry._meta.get_field(key), TimelineEntry._meta.get_field('post')])
+
+
+def _entries(user, key, after):
+    entries = TimelineEntry.objects.filter(user=user).order_by(f'-{key}', '-post_id')
+    if after:
+        entries = entries.filter(keyset_filter((f'-{key}', '-post_id'), after))
+    return entries.values_list(key, 'post_id')[:settings.FEED_PAGE_SIZE + 1]
+
+
+def _celebrity_posts(user, celebrities, key, ranked, after):
+    posts = Post.objects.filter(user__in=celebrities)
+    if ranked:
+        # scored like a timeline entry would be
+        affinities = ranking.author_affinities(user.id, celebrities)
+        affinity = Case(*[When(user_id=celebrity, then=Value(affinities[celebrity])) for celebrity in celebrities],
+                        default=Value(0.0), output_field=FloatField())
+        posts = posts.annotate(score=Coalesce(F('rank_score'), Value(0.0)) + affinity)
+    posts = posts.order_by(f'-{key}', '-id')
+    if after:
+        posts = posts.filter(keyset_filter((f'-{key}', '-id'), after))
+    return posts.values_list(key, 'id')[:settings.FEED_PAGE_SIZE + 1]
+
+
+def _cut(rows):
+    """
+    The post ids of the page in feed order and the cursor of the next one
+    """
+    per_page = settings.FEED_PAGE_SIZE
+    # a ranked post can come both from a timeline entry and from the celebrity merge, with different scores
+    best = {}
+    for key, post_id in rows:
+        if post_id not in best or key > best[post_id]:
+            best[post_id] = key
+    rows = sorted(((key, post_id) for post_id, key in best.items()), reverse=True)
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1])
+    return {post_id: position for position, (_, post_id) in enumerate(rows)}, next_cursor
+
+
+def get_timeline(user, cursor=None, ranked=False):
+    """
+    A page of the user's home feed: a slice of the precomputed timeline
+    merged with the latest (or top) posts of followed celebrities
+    """
+    key = 'score' if ranked else 'pub_date'
+    after = _after(cursor, key)
+    rows = list(_entries(user, key, after))
+    celebrities = followed_celebrities(user)
+    if celebrities:
+        rows += _celebrity_posts(user, celebrities, key, ranked, after)
+    order, next_cursor = _cut(rows)
+    posts = Post.objects.for_feed(user).filter(id__in=order)
+    return KeysetPage(sorted(posts, key=lambda post: order[post.id]), next_cursor)
+
+
+async def aget_timeline(user, cursor=None, ranked=False):
+    """
+    get_timeline for async views, the timeline slice and the followed celebrities are fetched concurrently
+    """
+    key = 'score' if ranked else 'pub_date'
+    after = _after(cursor, key)
+    rows, celebrities = await asyncio.gather(
+        alist(_entries(user, key, after)), alist(_followed_celebrities(user)))
+    if celebrities:
+        # ranked celebrity posts need the viewer's affinities, which are sync
+        posts = await sync_to_async(_celebrity_posts)(user, celebrities, key, ranked, after)
+        rows += await alist(posts)
+    order, next_cursor = _cut(rows)
+    posts = await alist(Post.objects.for_feed(user).filter(id__in=order))
+    return KeysetPage(sorted(posts, key=lambda post: order[post.id]), next_cursor)
@@ -0,0 +1,100 @@
+import os
+from uuid import uuid4
+
+from django import forms
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.urls import reverse
+
+from feed.models import ConfirmedUpload
+
+SALT = 'feed.uploads'
+
+UPLOAD_PATHS = {
+    'photo': 'feed/profiles_photos',
+    'avatar': 'feed/avatars',
+}
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+
+
+def _is_s3(storage):
+    return hasattr(storage, 'bucket')
+
+
+def is_local():
+    """
+    Files are stored locally, uploads go through views.upload_local instead of a bucket
+    """
+    return not _is_s3(default_storage)
+
+
+def create_ticket(user, kind, filename):
+    """
+    A signed upload slot: the browser posts the file straight to the storage,
+    then sends the token back so the row only references an uploaded object
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if kind not in UPLOAD_PATHS:
+        raise ValidationError('Unknown upload kind.', code='kind')
+    if extension not in IMAGE_EXTENSIONS:
+        raise ValidationError('Only images can be uploaded.', code='extension')
+
+    key = f'{UPLOAD_PATHS[kind]}/{user.id}/{uuid4().hex}{extension}'
+    token = signing.dumps({'key': key, 'user': user.id, 'kind': kind}, salt=SALT)
+
+    if _is_s3(default_storage):
+        fields = {'acl': default_storage.default_acl} if default_storage.default_acl else {}
+        conditions = [
+            ['content-length-range', 1, settings.UPLOAD_MAX_SIZE],
+            ['starts-with', '$Content-Type', 'image/'],
+        ] + [{name: value} for name, value in fields.items()]
+        presigned = default_storage.bucket.meta.client.generate_presigned_post(
+            default_storage.bucket_name,
+            '/'.join(filter(None, [default_storage.location, key])),
+            Fields=fields,
+            Conditions=conditions,
+            ExpiresIn=settings.UPLOAD_TICKET_EXPIRES,
+        )
+    else:
+        # local stand-in for the bucket, see views.upload_local
+        presigned = {'url': reverse('feed:upload_local'), 'fields': {'token': token}}
+    return {'url': presigned['url'], 'fields': presigned['fields'], 'token': token}
+
+
+def read_ticket(user, token, kind=None):
+    try:
+        ticket = signing.loads(token, salt=SALT, max_age=settings.UPLOAD_TICKET_EXPIRES)
+    except signing.BadSignature:
+        raise ValidationError('Invalid or expired upload.', code='token')
+    if ticket['user'] != user.id or (kind and ticket['kind'] != kind):
+        raise ValidationError('Invalid or expired upload.', code='token')
+    return ticket
+
+
+def confirm_upload(user, token, kind):
+    """
+    The storage key of a finished upload, each token is confirmed once
+    """
+    key = read_ticket(user, token, kind)['key']
+    if not default_storage.exists(key):
+        raise ValidationError('The file has not been uploaded.', code='missing')
+    if default_storage.size(key) > settings.UPLOAD_MAX_SIZE:
+        default_storage.delete(key)
+        raise ValidationError('The file is too large.', code='size')
+    try:
+        with transaction.atomic():
+            ConfirmedUpload.objects.create(key=key)
+    except IntegrityError:
+        raise ValidationError('The file has already been used.', code='used')
+    # the storage only checked the extension and the Content-Type the browser claimed
+    try:
+        with default_storage.open(key) as file:
+            forms.ImageField().clean(file)
+    except ValidationError:
+        default_storage.delete(key)
+        raise
+    return key
@@ -7,23 +7,53 @@ from django.views.generic import TemplateView
 from django_registration.backends.activation.views import ActivationView
 
 from djangogramm_15 import settings
-from . import views
+from . import async_views, uploads, views
 from .forms import CustomPasswordResetForm
 
 app_name = 'feed'
 
+if settings.FEED_ASYNC_VIEWS:
+    # coroutine read path for ASGI deployments, see feed.async_views
+    index_view, post_view, profile_view, like_view = (
+        async_views.index, async_views.post_detail, async_views.profile_detail, async_views.like)
+else:
+    index_view, post_view, profile_view, like_view = (
+        views.IndexView.as_view(), views.PostView.as_view(), views.ProfileView.as_view(), views.like)
+
 urlpatterns = [
     # FEED
-    path('feed/', views.IndexView.as_view(), name='index'),
+    path('feed/', index_view, name='index'),
     path('', lambda request: redirect('feed/', permanent=True)),
-    path('feed/<int:pk>/', views.PostView.as_view(), name='post'),  # ex: feed/5/
-    path('feed/like/', views.like, name='like'),
-    path('feed/profile/<slug:slug>/', views.ProfileView.as_view(), name='profile'),  # ex: feed/profile/alice
+    path('feed/<int:pk>/', post_view, name='post'),  # ex: feed/5/
+    path('feed/like/', like_view, name='like'),
+    path('feed/posts/', views.posts_page, name='posts_page'),  # ex: feed/posts/?cursor=...
+    path('feed/mode/', views.feed_mode, name='feed_mode'),
+    path('feed/tags/<str:name>/', views.TagView.as_view(), name='tag'),  # ex: feed/tags/sunset/
+    path('feed/mentions/', views.MentionsView.as_view(), name='mentions'),
+    path('feed/notifications/', views.NotificationsView.as_view(), name='notifications'),
+    path('feed/search/', views.SearchView.as_view(), name='search'),  # ex: feed/search/?q=sunny&type=people
+    path('feed/profile/<slug:slug>/', profile_view, name='profile'),  # ex: feed/profile/alice
     path('feed/profile/<slug:slug>/followers', views.FollowersView.as_view(), name='followers'),
     path('feed/profile/<slug:slug>/followings', views.FollowingsView.as_view(), name='followings'),
     path('feed/profile/update/<slug:slug>/', views.UpdateProfileView.as_view(),
         name='profile_update'),
 
+    # PUSH EVENTS
+    *([path('feed/events/', async_views.push_events, name='push_events')] if settings.PUSH_EVENTS else []),
+
+    # ACCOUNT EXPORT
+    path('feed/export/', views.ExportView.as_view(), name='exports'),
+    path('feed/export/<int:pk>/', views.export_download, name='export_download'),
+
+    # DIRECT UPLOADS
+    path('feed/uploads/ticket/', views.upload_ticket, name='upload_ticket'),
+    # stand-in for the bucket with local file storage
+    *([path('feed/uploads/local/', views.upload_local, name='upload_local')] if uploads.is_local() else []),
+    path('feed/uploads/avatar/', views.confirm_avatar, name='confirm_avatar'),
+
+    # MONITORING
+    path('metrics/', views.metrics, name='metrics'),
+
     # REGISTRATION
     path('registration/', views.CustomRegistrationView.as_view(),
         name='django_registration_register'),
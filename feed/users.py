@@ -0,0 +1,61 @@
+from functools import partial
+
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils.crypto import constant_time_compare
+
+from feed.models import Profile, User
+
+
+def _key(user_id):
+    return f'users:{user_id}'
+
+
+def _forget(user_id):
+    cache.delete(_key(user_id))
+
+
+def invalidate(user_id):
+    _forget(user_id)
+    # a request reading before the commit may have cached the old rows again
+    transaction.on_commit(partial(_forget, user_id))
+
+
+def _snapshot(user):
+    """
+    Cache the user with its profile joined, request.user.profile is read on every page by the navbar
+    """
+    try:
+        user.profile = Profile.objects.defer('search_vector').get(user=user)
+    except Profile.DoesNotExist:
+        pass
+    cache.set(_key(user.pk), user, settings.USER_CACHE_TIMEOUT)
+
+
+def get_user(request):
+    """
+    django.contrib.auth.get_user served from the cache. Only an active user whose session hash matches
+    is returned from there, everything else (unknown sessions, rotated secrets, changed passwords)
+    goes through Django's own checks, as does every request without a SHARED_CACHE
+    """
+    if not settings.SHARED_CACHE:
+        return auth.get_user(request)
+    try:
+        user_id = User._meta.pk.to_python(request.session[SESSION_KEY])
+        backend_path = request.session[BACKEND_SESSION_KEY]
+    except (KeyError, ValidationError):
+        return auth.get_user(request)
+    session_hash = request.session.get(HASH_SESSION_KEY)
+    user = cache.get(_key(user_id))
+    if (user is not None and user.is_active and session_hash and backend_path in settings.AUTHENTICATION_BACKENDS
+            and constant_time_compare(session_hash, user.get_session_auth_hash())):
+        return user
+
+    user = auth.get_user(request)
+    if user.is_authenticated:
+        _snapshot(user)
+    return user
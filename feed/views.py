@@ -1,17 +1,38 @@
+from functools import partial
+
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.db.models import Count
-from django.http import HttpResponseRedirect, JsonResponse
-from django.shortcuts import render, redirect
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+from django.http import Http404, HttpResponse, HttpResponsePermanentRedirect, HttpResponseRedirect, JsonResponse
+from django.shortcuts import render, redirect, get_object_or_404
 from django.template.loader import render_to_string
 from django.urls import reverse_lazy, reverse
+from django.utils.http import urlencode
+from django.views.decorators.http import require_POST
 from django.views.generic import View, DetailView, UpdateView, ListView
 from django_registration.backends.activation.views import RegistrationView
 
 from djangogramm_15 import settings
+from . import (counters, graph, mail, notifications, recommendations, search, services, slugs, tags, timeline,
+               uploads, users)
+from .middleware import can_read_metrics, registry
 from .forms import CreatePostForm, PostImageFormSet, CustomRegisterForm
-from .models import Post, Profile, Photo, User, Follower, Like
-from .tasks import send_register_email_async
+from .models import AccountExport, Post, Profile, Photo, User, Follower, Tag
+from .pagination import KeysetPaginator
+from .tasks import export_account, process_avatar_variants
+
+
+def _profile_posts(profile, viewer, cursor=None):
+    return KeysetPaginator(Post.objects.for_feed(viewer).filter(user=profile.user)).page(cursor)
+
+
+def _next_page_url(page, **params):
+    if not page.has_next:
+        return None
+    return f"{reverse('feed:posts_page')}?{urlencode(dict(params, cursor=page.next_cursor))}"
 
 
 class CustomRegistrationView(RegistrationView):
@@ -37,11 +58,8 @@ class CustomRegistrationView(RegistrationView):
             request=self.request,
         )
 
-        # send an email with celery
-        send_register_email_async.delay(user_id=user.id,
-                                        subject=subject,
-                                        message=message,
-                                        from_email=settings.DEFAULT_FROM_EMAIL)
+        # queued and sent in batches with celery
+        mail.enqueue(user.email, subject, message, from_email=settings.DEFAULT_FROM_EMAIL)
 
 
 class IndexView(LoginRequiredMixin, View):
@@ -49,44 +67,72 @@ class IndexView(LoginRequiredMixin, View):
     template_name = 'feed/index.html'
 
     def get(self, request, *args, **kwargs):
-        following = Follower.objects.filter(follower=request.user).values_list('following__id')
-        posts_data = Post.objects.filter(user__id__in=following)
-        liked_posts = Post.objects.filter(likes__user=request.user)
+        feed_mode = request.user.profile.feed_mode
+        posts_data = timeline.get_timeline(request.user, request.GET.get('cursor'),
+                                           ranked=feed_mode == Profile.RANKED)
         context = {
             'posts_data': posts_data,
-            'liked_posts': liked_posts,
+            'feed_mode': feed_mode,
+            'feed_modes': Profile.FEED_MODES,
+            'next_page_url': _next_page_url(posts_data),
             'form': CreatePostForm(),
             'form_images': PostImageFormSet()
         }
 
         # ask to follow somebody
         if not posts_data:
-            all_users = User.objects.exclude(username=request.user.username)
-            context['all_users'] = all_users
+            context['suggested_users'] = recommendations.for_user(request.user, settings.SUGGESTIONS_SHOWN)
 
         return render(request, self.template_name, context=context)
 
     def post(self, request, *args, **kwargs):
-        post = Post.objects.create(user=request.user)
-        form = CreatePostForm(request.POST, request.FILES, instance=post)
+        form = CreatePostForm(request.POST, request.FILES)
         if form.is_valid():
-            new_post = form.save(commit=False)
-            new_post.user = request.user
-            new_post.save()
-            for key in form.files:
-                photo_files = form.files.getlist(key)
-                for file in photo_files:
-                    Photo.objects.create(photo=file, user=request.user, post=new_post)
+            files = [file for key in request.FILES for file in request.FILES.getlist(key)]
+            upload_tokens = request.POST.getlist('upload_token')
             # prevent posting an empty posts
-            if not post.text and not post.photos.all().exists():
-                post.delete(keep_parents=True)
-            return HttpResponseRedirect('/feed/')
-        else:
-            form = CreatePostForm()
-        return render(request, self.template_name, {"form": form})
+            if not form.cleaned_data['text'] and not files and not upload_tokens:
+                return HttpResponseRedirect('/feed/')
+            try:
+                # a token is used up only together with the post, a rejected post leaves it for the next try
+                with transaction.atomic():
+                    uploaded_keys = [uploads.confirm_upload(request.user, token, 'photo') for token in upload_tokens]
+                    services.create_post(request.user, form.cleaned_data['text'], files, uploaded_keys)
+            except ValidationError as error:
+                form.add_error(None, error)
+            else:
+                return HttpResponseRedirect('/feed/')
+        return render(request, self.template_name, {'form': form, 'form_images': PostImageFormSet()})
+
+
+def _current_slug_redirect(request, profile, **kwargs):
+    url = reverse(request.resolver_match.view_name, kwargs=dict(kwargs, slug=profile.slug))
+    if request.GET:
+        url = f'{url}?{request.GET.urlencode()}'
+    return HttpResponsePermanentRedirect(url)
+
+
+class ProfileSlugMixin:
+    """
+    Resolves the profile of the url's slug once per request, a former slug of a renamed user
+    redirects to the current one
+    """
+    profile_queryset = Profile.objects.select_related('user')
 
+    def dispatch(self, request, *args, **kwargs):
+        # after LoginRequiredMixin, anonymous requests are redirected before this
+        self.profile = slugs.lookup(kwargs['slug'], self.profile_queryset)
+        if self.profile is None:
+            raise Http404('No such profile.')
+        if self.profile.slug != kwargs['slug'] and request.method in ('GET', 'HEAD'):
+            return _current_slug_redirect(request, self.profile, **kwargs)
+        return super().dispatch(request, *args, **kwargs)
 
-class ProfileView(LoginRequiredMixin, DetailView):
+    def get_object(self, queryset=None):
+        return self.profile
+
+
+class ProfileView(LoginRequiredMixin, ProfileSlugMixin, DetailView):
     login_url = 'feed:login'
     model = Profile
     template_name = 'feed/profile.html'
@@ -94,56 +140,159 @@ class ProfileView(LoginRequiredMixin, DetailView):
     def get_context_data(self, *args, **kwargs):
         context = super().get_context_data(**kwargs)
         profile = self.object
-        context['followers_count'] = Follower.objects.filter(following=profile.user).exclude(following=profile.user).count()
-        context['following_count'] = Follower.objects.filter(follower=profile.user).exclude(following=profile.user).count()
-        context['is_following'] = Follower.objects.filter(follower=self.request.user, following=profile.user).exists()
-        context['liked_posts'] = Post.objects.filter(likes__user=self.request.user)
+        viewer_id = self.request.user.id
+        viewer_followings = graph.followings(viewer_id)
+        context['is_following'] = profile.user_id in viewer_followings
+        context['follows_viewer'] = graph.is_following(profile.user_id, viewer_id)
+        known = graph.known_followers(profile.user_id, viewer_followings)
+        context['known_followers'] = graph.known_follower_names(known)
+        context['known_followers_count'] = known.count()
+        context['posts'] = _profile_posts(profile, self.request.user, self.request.GET.get('cursor'))
+        context['next_page_url'] = _next_page_url(context['posts'], slug=profile.slug)
         return context
 
     def post(self, request, *args, **kwargs):
         profile = self.get_object()
-        if Follower.objects.filter(follower=request.user, following=profile.user).exists():
-            Follower.objects.filter(follower=request.user, following=profile.user).delete()
-        else:
-            Follower.objects.create(follower=request.user, following=profile.user)
-        return redirect('feed:profile', profile.user.username)
+        if profile.user == request.user:
+            return redirect('feed:profile', profile.slug)
+        with transaction.atomic():
+            deleted, _ = Follower.objects.filter(follower=request.user, following=profile.user).delete()
+            if deleted:
+                counters.add_follows(request.user.id, profile.user_id, -1)
+            else:
+                # a concurrent follow (a double click) may have inserted the row since, count it once
+                _, created = Follower.objects.get_or_create(follower=request.user, following=profile.user)
+                if created:
+                    counters.add_follows(request.user.id, profile.user_id, 1)
+        return redirect('feed:profile', profile.slug)
 
 
-class UpdateProfileView(LoginRequiredMixin, UpdateView):
+class SearchView(LoginRequiredMixin, View):
+    login_url = 'feed:login'
+    template_name = 'feed/search.html'
+
+    def get(self, request, *args, **kwargs):
+        query = request.GET.get('q', '').strip()[:100]
+        kind = 'people' if request.GET.get('type') == 'people' else 'posts'
+        context = {'query': query, 'kind': kind, 'results': None}
+        if query:
+            cursor = request.GET.get('cursor')
+            if kind == 'people':
+                results = search.search_profiles(query, cursor)
+            else:
+                results = search.search_posts(request.user, query, cursor)
+            context['results'] = results
+            if results.has_next:
+                context['next_page_url'] = '?' + urlencode({'q': query, 'type': kind, 'cursor': results.next_cursor})
+        return render(request, self.template_name, context=context)
+
+
+class TagView(LoginRequiredMixin, View):
+    login_url = 'feed:login'
+    template_name = 'feed/tag.html'
+
+    def get(self, request, name, *args, **kwargs):
+        tag = get_object_or_404(Tag, name=name.lower())
+        posts = tags.tag_posts(tag, request.user, request.GET.get('cursor'))
+        context = {'tag': tag, 'posts': posts, 'next_page_url': _next_page_url(posts, tag=tag.name)}
+        return render(request, self.template_name, context=context)
+
+
+class MentionsView(LoginRequiredMixin, View):
+    login_url = 'feed:login'
+    template_name = 'feed/mentions.html'
+
+    def get(self, request, *args, **kwargs):
+        posts = tags.mentions(request.user, request.user, request.GET.get('cursor'))
+        context = {'posts': posts, 'next_page_url': _next_page_url(posts, mentions=1)}
+        return render(request, self.template_name, context=context)
+
+
+class NotificationsView(LoginRequiredMixin, View):
+    login_url = 'feed:login'
+    template_name = 'feed/notifications.html'
+
+    def get(self, request, *args, **kwargs):
+        context = {'notifications': notifications.inbox(request.user, request.GET.get('cursor'))}
+        return render(request, self.template_name, context=context)
+
+    def post(self, request, *args, **kwargs):
+        notifications.mark_read(request.user.id)
+        return redirect('feed:notifications')
+
+
+class ExportView(LoginRequiredMixin, View):
+    login_url = 'feed:login'
+    template_name = 'feed/exports/exports.html'
+
+    def get(self, request, *args, **kwargs):
+        exports = AccountExport.objects.filter(user=request.user)[:5]
+        in_progress = any(export.status in (AccountExport.PENDING, AccountExport.RUNNING) for export in exports)
+        return render(request, self.template_name, context={'exports': exports, 'in_progress': in_progress})
+
+    def post(self, request, *args, **kwargs):
+        running = AccountExport.objects.filter(user=request.user,
+                                               status__in=(AccountExport.PENDING, AccountExport.RUNNING))
+        if not running.exists():
+            # only the latest archive is kept
+            for export in AccountExport.objects.filter(user=request.user).exclude(archive=''):
+                export.archive.delete(save=False)
+            AccountExport.objects.filter(user=request.user).delete()
+            export = AccountExport.objects.create(user=request.user)
+            transaction.on_commit(partial(export_account.delay, export.id,
+                                          request.build_absolute_uri(reverse('feed:exports'))))
+        return redirect('feed:exports')
+
+
+@login_required
+def export_download(request, pk):
+    export = get_object_or_404(AccountExport, pk=pk, user=request.user, status=AccountExport.DONE)
+    return redirect(export.archive.url)
+
+
+class UpdateProfileView(LoginRequiredMixin, ProfileSlugMixin, UpdateView):
     login_url = 'feed:login'
     model = Profile
     fields = ['full_name', 'avatar', 'bio']
     template_name = 'feed/profile_update.html'
 
+    def form_valid(self, form):
+        if 'avatar' in form.changed_data:
+            form.instance.avatar_variants = {}
+            transaction.on_commit(partial(process_avatar_variants.delay, form.instance.id))
+        return super().form_valid(form)
+
     def get_success_url(self):
         return reverse_lazy('feed:profile', kwargs={'slug': self.object.slug})
 
 
-class FollowersView(LoginRequiredMixin, ListView):
+class FollowersView(LoginRequiredMixin, ProfileSlugMixin, ListView):
     login_url = 'feed:login'
     model = Follower
     template_name = 'feed/followers.html'
 
     def get_context_data(self, *args, **kwargs):
         context = super().get_context_data(**kwargs)
-        profile_slug = self.kwargs.get('slug')
-        profile = Profile.objects.get(slug=profile_slug)
+        profile = self.profile
         context['profile'] = profile
-        context['followers'] = Follower.objects.filter(following=profile.user).exclude(following=profile.user)
+        followers = Follower.objects.filter(following=profile.user).exclude(follower=F('following'))
+        context['followers'] = KeysetPaginator(followers.select_related('follower__profile'), keys=('-id',),
+                                               per_page=settings.FOLLOWERS_PAGE_SIZE).page(self.request.GET.get('cursor'))
         return context
 
 
-class FollowingsView(LoginRequiredMixin, ListView):
+class FollowingsView(LoginRequiredMixin, ProfileSlugMixin, ListView):
     login_url = 'feed:login'
     model = Follower
     template_name = 'feed/followings.html'
 
     def get_context_data(self, *args, **kwargs):
         context = super().get_context_data(**kwargs)
-        profile_slug = self.kwargs.get('slug')
-        profile = Profile.objects.get(slug=profile_slug)
+        profile = self.profile
         context['profile'] = profile
-        context['followings'] = Follower.objects.filter(follower=profile.user).exclude(following=profile.user)
+        followings = Follower.objects.filter(follower=profile.user).exclude(follower=F('following'))
+        context['followings'] = KeysetPaginator(followings.select_related('following__profile'), keys=('-id',),
+                                                per_page=settings.FOLLOWERS_PAGE_SIZE).page(self.request.GET.get('cursor'))
         return context
 
 
@@ -152,22 +301,127 @@ class PostView(LoginRequiredMixin, DetailView):
     model = Post
     template_name = 'feed/post.html'
 
-    def get_context_data(self, *args, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context['liked_posts'] = Post.objects.filter(likes__user=self.request.user)
-        return context
+    def get_queryset(self):
+        return Post.objects.for_feed(self.request.user)
+
+
+@login_required
+@require_POST
+def upload_ticket(request):
+    """
+    A presigned POST to upload a photo or an avatar straight to the storage
+    """
+    try:
+        ticket = uploads.create_ticket(request.user, request.POST.get('kind'), request.POST.get('filename', ''))
+    except ValidationError as error:
+        return JsonResponse({'errors': error.messages}, status=400)
+    return JsonResponse(ticket)
 
 
 @login_required
+@require_POST
+def upload_local(request):
+    """
+    Stand-in for the bucket when the files are stored locally
+    """
+    file = request.FILES.get('file')
+    try:
+        key = uploads.read_ticket(request.user, request.POST.get('token', ''))['key']
+        if file is None or file.size > settings.UPLOAD_MAX_SIZE:
+            raise ValidationError('Missing or too large file.', code='size')
+        # a bucket key is written once too
+        if default_storage.exists(key):
+            raise ValidationError('Invalid or expired upload.', code='token')
+    except ValidationError as error:
+        return JsonResponse({'errors': error.messages}, status=400)
+    default_storage.save(key, file)
+    return HttpResponse(status=204)
+
+
+@login_required
+@require_POST
+def confirm_avatar(request):
+    profile = request.user.profile
+    try:
+        with transaction.atomic():
+            profile.avatar = uploads.confirm_upload(request.user, request.POST.get('token', ''), 'avatar')
+            profile.avatar_variants = {}
+            profile.save()
+    except ValidationError as error:
+        return JsonResponse({'errors': error.messages}, status=400)
+    transaction.on_commit(partial(process_avatar_variants.delay, profile.id))
+    return JsonResponse({'avatar': profile.avatar.url})
+
+
+@login_required
+@require_POST
+def feed_mode(request):
+    mode = request.POST.get('feed_mode')
+    if mode in dict(Profile.FEED_MODES):
+        Profile.objects.filter(user=request.user).update(feed_mode=mode)
+        users.invalidate(request.user.id)
+    return redirect('feed:index')
+
+
+@login_required
+def posts_page(request):
+    """
+    The next page of the home feed, a profile, a tag or the mentions as an html fragment for infinite scroll
+    """
+    cursor = request.GET.get('cursor')
+    slug = request.GET.get('slug')
+    tag = request.GET.get('tag')
+    params = {}
+    if slug:
+        profile = slugs.lookup(slug)
+        if profile is None:
+            raise Http404('No such profile.')
+        page = _profile_posts(profile, request.user, cursor)
+        params['slug'] = slug
+    elif tag:
+        page = tags.tag_posts(get_object_or_404(Tag, name=tag), request.user, cursor)
+        params['tag'] = tag
+    elif request.GET.get('mentions'):
+        page = tags.mentions(request.user, request.user, cursor)
+        params['mentions'] = 1
+    else:
+        page = timeline.get_timeline(request.user, cursor, ranked=request.user.profile.feed_mode == Profile.RANKED)
+    html = render_to_string('feed/posts_page.html', {'posts_data': page}, request=request)
+    return JsonResponse({'html': html, 'next_page_url': _next_page_url(page, **params)})
+
+
+def _like_params(request):
+    """
+    (post_id, liked) of a like request, (None, None) when they are invalid
+    """
+    action = request.POST.get('action', 'like')
+    post_id = request.POST.get('post_id')
+    if action not in ('like', 'unlike') or not str(post_id).isdigit():
+        return None, None
+    return int(post_id), action == 'like'
+
+
+@login_required
+@require_POST
 def like(request):
-    if request.method == 'POST':
-        post_id = request.POST.get('post_id')
-        post = Post.objects.get(pk=post_id)
-
-        if post.likes.filter(user=request.user, post=post).exists():
-            post.likes.filter(user=request.user, post=post).delete()
-            return JsonResponse({'unliked': True})
-        else:
-            post.likes.create(user=request.user, post=post)
-            return JsonResponse({'liked': True})
-    return HttpResponseRedirect(reverse('index'))
+    """
+    Set (not toggle) the like of the viewer, repeating a request changes nothing.
+    Returns the new state and the like count of the post
+    """
+    post_id, liked = _like_params(request)
+    if post_id is None:
+        return JsonResponse({'errors': ['Expected a post_id and action=like|unlike.']}, status=400)
+    try:
+        count = counters.set_like(request.user.id, post_id, liked)
+    except Post.DoesNotExist:
+        raise Http404('No such post.')
+    return JsonResponse({'liked': liked, 'like_count': count})
+
+
+def metrics(request):
+    """
+    Prometheus scrape endpoint for the sampled request stats of this process
+    """
+    if not can_read_metrics(request):
+        return HttpResponse(status=403)
+    return HttpResponse(registry.render() + mail.render_metrics(), content_type='text/plain; version=0.0.4')